@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import uuid
+import gc
+import threading
+import multiprocessing
+
+from aiohttp import web
+import torch
+import execution
+import output_writer
+import comfy.model_management
+from nodes import init_custom_nodes
+
+class HeadlessServer:
+    """
+    Stands in for the PromptServer when prompts are executed without the web server,
+    it only keeps the error of the last prompt. It is also the PromptServer.instance for
+    the custom nodes that use it.
+    """
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.error = None
+        #routes the custom nodes add are never served
+        self.routes = web.RouteTableDef()
+
+    def send_sync(self, event, data, sid=None):
+        if event in ("execution_error", "execution_interrupted"):
+            self.error = data
+
+    def queue_updated(self):
+        pass
+
+def load_nodes(init):
+    #custom nodes use PromptServer.instance when they are imported and executed
+    from server import PromptServer
+    headless = HeadlessServer()
+    PromptServer.instance = headless
+    init()
+    init_custom_nodes()
+    return execution.PromptExecutor(headless)
+
+def run_job_safe(executor, job):
+    #an exception never stops the batch, it ends up in the result of the job
+    try:
+        return run_job(executor, job)
+    except Exception as e:
+        return {"line": job[0], "id": None, "status": "error", "error": {"type": "exception", "message": str(e)}}
+
+def read_jobs(path):
+    #each line is either a prompt or a {"prompt": ..., "id": ..., "extra_data": ...} object
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if len(line) > 0:
+                yield (i + 1, line, time.time())
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_job(executor, job):
+    line_number, line, read_time = job
+    start_time = time.time()
+    result = {"line": line_number, "id": None, "status": "error"}
+    try:
+        data = json.loads(line)
+    except ValueError as e:
+        result["error"] = {"type": "invalid_json", "message": str(e)}
+        return result
+    if not isinstance(data, dict):
+        result["error"] = {"type": "invalid_prompt", "message": "Each line has to be a json object"}
+        return result
+
+    prompt = data.get("prompt", data)
+    prompt_id = str(data.get("id", uuid.uuid4()))
+    extra_data = dict(data.get("extra_data", {}), client_id="batch")
+    result["id"] = prompt_id
+
+    try:
+        valid = execution.validate_prompt(prompt)
+    except Exception as e:
+        valid = (False, {"type": "invalid_prompt", "message": str(e)}, [], {})
+    validated_time = time.time()
+    if not valid[0]:
+        result["error"] = valid[1]
+        result["node_errors"] = valid[3]
+        return result
+
+    executor.server.error = None
+    output_writer.set_current_prompt(prompt_id)
+    executor.execute(prompt, prompt_id, extra_data, valid[2])
+    flushed = threading.Event()
+    output_writer.when_flushed(prompt_id, flushed.set)
+    flushed.wait()
+    done_time = time.time()
+
+    if executor.server.error is None:
+        result["status"] = "success"
+    else:
+        result["error"] = executor.server.error
+    result["outputs"] = executor.outputs_ui
+    result["profile"] = executor.profile
+    result["timings"] = {
+        "queue_wait": start_time - read_time,
+        "validation": validated_time - start_time,
+        "execution": done_time - validated_time,
+    }
+
+    gc.collect()
+    comfy.model_management.soft_empty_cache()
+    return result
+
+def worker_main(init, jobs, results, threads):
+    sys.stdout = sys.stderr
+    if threads > 0:
+        torch.set_num_threads(threads)
+    executor = load_nodes(init)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        results.put(run_job_safe(executor, job))
+
+def run(jobs_path, output_path="-", workers=1, init=lambda: None, threads=0):
+    """
+    Executes the prompts of a jobs file (or stdin with "-") without starting the web server and writes one
+    json line per prompt with its status, outputs, profile and timings in the order they finish. With more
+    than one worker the prompts are executed by that many processes, each limited to threads torch threads
+    (0 splits the cpu cores between them). init gets called in each process
+    before the custom nodes are loaded. Returns the process exit code.
+    """
+    output = sys.stdout if output_path == "-" else open(output_path, "w", encoding="utf-8")
+    #the prints of the nodes and executor go to stderr so they don't end up in the results
+    sys.stdout = sys.stderr
+    failed = 0
+    total = 0
+
+    def write_result(result):
+        nonlocal failed, total
+        total += 1
+        if result["status"] != "success":
+            failed += 1
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    start_time = time.perf_counter()
+    if workers <= 1:
+        executor = load_nodes(init)
+        for job in read_jobs(jobs_path):
+            write_result(run_job_safe(executor, job))
+    else:
+        context = multiprocessing.get_context("spawn")
+        jobs = context.Queue(maxsize=workers * 2)
+        results = context.Queue()
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        processes = [context.Process(target=worker_main, args=(init, jobs, results, threads), daemon=True) for i in range(workers)]
+        for p in processes:
+            p.start()
+
+        count = 0
+        def feed():
+            nonlocal count
+            for job in read_jobs(jobs_path):
+                jobs.put(job)
+                count += 1
+            for p in processes:
+                jobs.put(None)
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        received = 0
+        while feeder.is_alive() or received < count:
+            try:
+                result = results.get(timeout=1.0)
+            except Exception:
+                if not any(p.is_alive() for p in processes):
+                    print("All batch workers exited with {} prompts left".format(count - received))
+                    failed += count - received
+                    break
+                continue
+            received += 1
+            write_result(result)
+
+        for p in processes:
+            p.join()
+
+    if output_path != "-":
+        output.close()
+    print("Executed {} prompts ({} failed) in {:.2f} seconds".format(total, failed, time.perf_counter() - start_time))
+    return 1 if failed > 0 else 0
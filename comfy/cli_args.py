@@ -81,6 +81,45 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 
+parser.add_argument("--cache-ram-budget", type=float, default=0.0, metavar="GB", help="Amount of memory in GB that node outputs from previous prompts can keep using so identical nodes in later prompts don't get executed again. The outputs of the last executed prompt are always kept.")
+
+parser.add_argument("--cache-spill-directory", type=str, default=None, help="When the cached node outputs go over --cache-ram-budget, write their tensors to this directory instead of dropping them and read them back when a later prompt needs them.")
+parser.add_argument("--cache-spill-budget", type=float, default=32.0, metavar="GB", help="Amount of disk space in GB the spilled node outputs can use.")
+
+parser.add_argument("--persistent-cache-directory", type=str, default=None, help="Store the outputs of executed nodes that only contain tensors (conditioning, latents, images, etc...) in this directory so they are still cached after a restart. Output nodes are never stored.")
+parser.add_argument("--persistent-cache-size", type=float, default=32.0, metavar="GB", help="Maximum size in GB of the persistent cache directory, the least recently used outputs get deleted first.")
+
+parser.add_argument("--parallel-cpu-nodes", type=int, default=0, metavar="THREADS", help="Run nodes marked as THREAD_SAFE (image loading and saving, mask operations, etc...) on a pool of this many threads so they overlap with the other nodes. By default every node runs on the prompt worker thread.")
+
+parser.add_argument("--output-writer-threads", type=int, default=0, metavar="THREADS", help="Encode and write the images from the save and preview image nodes on this many background threads so the next prompt can start right away. The history entry of a prompt is added once all its files are written. By default images are written by the node itself.")
+
+parser.add_argument("--seed-batch-size", type=int, default=1, metavar="PROMPTS", help="Sample up to this many queued prompts that only differ by their sampler seeds in a single batch. Only used with samplers that don't add noise while sampling so the results are the same as running the prompts one by one.")
+
+parser.add_argument("--history-database", type=str, default=None, metavar="PATH", help="Store the prompt history in this sqlite database so it is kept after a restart. By default the history is only kept in memory.")
+parser.add_argument("--history-max-items", type=int, default=10000, help="Number of the most recent prompts to keep in the history, 0 keeps everything.")
+parser.add_argument("--history-max-age", type=float, default=0.0, metavar="HOURS", help="Delete prompts older than this from the history, 0 keeps them forever.")
+
+parser.add_argument("--queue-journal", type=str, default=None, metavar="PATH", help="Journal the prompt queue operations to this file so pending prompts are queued again after a crash or restart.")
+
+parser.add_argument("--scheduler", type=str, default="fifo", choices=["fifo", "sjf", "fair", "affinity"], help="How the next prompt to execute is picked from the queue: fifo in the order they were queued, sjf the prompt with the lowest estimated cost first, fair weighted fair queueing between client ids, affinity the prompts needing the fewest model loads and lora patches on top of the loaded models first.")
+parser.add_argument("--scheduler-max-skips", type=int, default=8, metavar="COUNT", help="With the sjf and affinity schedulers, how many newer prompts can run before a queued prompt before it is executed no matter its cost or models.")
+parser.add_argument("--client-weight", type=str, action="append", default=[], metavar="CLIENT_ID=WEIGHT", help="Weight of a client id for the fair scheduler, defaults to 1. Can be used multiple times.")
+
+parser.add_argument("--prefetch-models", action="store_true", help="Read the model files used by the next prompt in the queue in the background so they are in the OS file cache when it runs. With --state-dict-cache-size the safetensors files that fit are also loaded into that cache.")
+
+parser.add_argument("--max-queue-size", type=int, default=0, help="Reject new prompts with a 429 status when this many prompts are already queued, 0 means no limit.")
+parser.add_argument("--max-queue-cost", type=float, default=0.0, metavar="COST", help="Reject new prompts with a 429 status when the estimated cost of the queued prompts would go over this, in sampling steps of a 512x512 image. 0 means no limit.")
+parser.add_argument("--max-client-queue-size", type=int, default=0, help="Same as --max-queue-size but for the prompts of each client_id.")
+parser.add_argument("--max-client-queue-cost", type=float, default=0.0, metavar="COST", help="Same as --max-queue-cost but for the prompts of each client_id.")
+
+parser.add_argument("--batch", type=str, default=None, metavar="JOBS_FILE", help="Execute the prompts of a json lines file (- for stdin) without starting the web server, then exit. Each line is a prompt in the api format or an object with a prompt key and optional id and extra_data keys.")
+parser.add_argument("--batch-output", type=str, default="-", metavar="PATH", help="Where to write the result and timings of each --batch prompt as json lines, stdout by default.")
+parser.add_argument("--workers", type=int, default=1, help="Number of processes executing prompts (from the queue or from --batch). With more than one, safetensors model files are memory mapped so the processes share the weights.")
+parser.add_argument("--worker-threads", type=int, default=0, help="Number of torch threads of each --workers process, by default the cpu cores are split between them.")
+parser.add_argument("--mmap-models", action="store_true", help="Memory map safetensors model files instead of reading them: the weights of the models kept on the cpu point to the mapped file so they only use the memory of the OS file cache, which is shared with other processes.")
+parser.add_argument("--state-dict-cache-size", type=float, default=0.0, metavar="GB", help="Amount of RAM in GB used to keep the state dicts of the loaded model files so the loader nodes don't read the same file again. Disabled by default.")
+parser.add_argument("--model-detection-cache", type=str, default=None, metavar="PATH", help="Json file where the detected type of the checkpoint files is kept so they don't have to be inspected again after a restart. By default it is only kept in memory. Several processes can share the file.")
+
 parser.add_argument("--dont-print-server", action="store_true", help="Don't print server output.")
 parser.add_argument("--quick-test-for-ci", action="store_true", help="Quick test for CI.")
 parser.add_argument("--windows-standalone-build", action="store_true", help="Windows standalone build: Enable convenient things that most people using the standalone windows build will probably enjoy (like auto opening the page on startup).")
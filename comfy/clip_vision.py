@@ -1,5 +1,5 @@
 from transformers import CLIPVisionModelWithProjection, CLIPVisionConfig, CLIPImageProcessor, modeling_utils
-from .utils import load_torch_file, transformers_convert
+from .utils import load_torch_file, load_state_dict, transformers_convert
 import os
 import torch
 import comfy.ops
@@ -21,7 +21,7 @@ class ClipVisionModel():
                                             size=224)
 
     def load_sd(self, sd):
-        return self.model.load_state_dict(sd, strict=False)
+        return load_state_dict(self.model, sd, strict=False)
 
     def encode_image(self, image):
         img = torch.clip((255. * image[0]), 0, 255).round().int()
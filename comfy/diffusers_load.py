@@ -9,6 +9,7 @@ import re
 import torch
 from safetensors.torch import load_file, save_file
 from . import diffusers_convert
+from . import utils
 
 
 def load_diffusers(model_path, fp16=True, output_vae=True, output_clip=True, embedding_directory=None):
@@ -44,22 +45,22 @@ def load_diffusers(model_path, fp16=True, output_vae=True, output_clip=True, emb
 
     # Load models from safetensors if it exists, if it doesn't pytorch
     if osp.exists(unet_path):
-        unet_state_dict = load_file(unet_path, device="cpu")
+        unet_state_dict = utils.load_torch_file(unet_path)
     else:
         unet_path = osp.join(model_path, "unet", "diffusion_pytorch_model.bin")
-        unet_state_dict = torch.load(unet_path, map_location="cpu")
+        unet_state_dict = utils.load_torch_file(unet_path)
 
     if osp.exists(vae_path):
-        vae_state_dict = load_file(vae_path, device="cpu")
+        vae_state_dict = utils.load_torch_file(vae_path)
     else:
         vae_path = osp.join(model_path, "vae", "diffusion_pytorch_model.bin")
-        vae_state_dict = torch.load(vae_path, map_location="cpu")
+        vae_state_dict = utils.load_torch_file(vae_path)
 
     if osp.exists(text_enc_path):
-        text_enc_dict = load_file(text_enc_path, device="cpu")
+        text_enc_dict = utils.load_torch_file(text_enc_path)
     else:
         text_enc_path = osp.join(model_path, "text_encoder", "pytorch_model.bin")
-        text_enc_dict = torch.load(text_enc_path, map_location="cpu")
+        text_enc_dict = utils.load_torch_file(text_enc_path)
 
     # Convert the UNet model
     unet_state_dict = diffusers_convert.convert_unet_state_dict(unet_state_dict)
@@ -1,21 +1,34 @@
+import os
+import json
+import atexit
+import bisect
+import threading
 
 from . import supported_models
+from . import utils
+from comfy.cli_args import args
+
+def get_keys_with_prefix(sorted_keys, prefix):
+    start = bisect.bisect_left(sorted_keys, prefix)
+    end = start
+    while end < len(sorted_keys) and sorted_keys[end].startswith(prefix):
+        end += 1
+    return sorted_keys[start:end]
+
+def has_prefix(sorted_keys, prefix):
+    i = bisect.bisect_left(sorted_keys, prefix)
+    return i < len(sorted_keys) and sorted_keys[i].startswith(prefix)
 
 def count_blocks(state_dict_keys, prefix_string):
+    #sorting keys that are already sorted is linear
+    state_dict_keys = sorted(state_dict_keys)
     count = 0
-    while True:
-        c = False
-        for k in state_dict_keys:
-            if k.startswith(prefix_string.format(count)):
-                c = True
-                break
-        if c == False:
-            break
+    while has_prefix(state_dict_keys, prefix_string.format(count)):
         count += 1
     return count
 
 def detect_unet_config(state_dict, key_prefix, use_fp16):
-    state_dict_keys = list(state_dict.keys())
+    state_dict_keys = sorted(state_dict.keys())
 
     unet_config = {
         "use_checkpoint": False,
@@ -26,7 +39,7 @@ def detect_unet_config(state_dict, key_prefix, use_fp16):
     }
 
     y_input = '{}label_emb.0.0.weight'.format(key_prefix)
-    if y_input in state_dict_keys:
+    if y_input in state_dict:
         unet_config["num_classes"] = "sequential"
         unet_config["adm_in_channels"] = state_dict[y_input].shape[1]
     else:
@@ -53,7 +66,7 @@ def detect_unet_config(state_dict, key_prefix, use_fp16):
 
     while True:
         prefix = '{}input_blocks.{}.'.format(key_prefix, count)
-        block_keys = sorted(list(filter(lambda a: a.startswith(prefix), state_dict_keys)))
+        block_keys = set(get_keys_with_prefix(state_dict_keys, prefix))
         if len(block_keys) == 0:
             break
 
@@ -75,8 +88,7 @@ def detect_unet_config(state_dict, key_prefix, use_fp16):
                 last_channel_mult = state_dict["{}0.out_layers.3.weight".format(prefix)].shape[0] // model_channels
 
             transformer_prefix = prefix + "1.transformer_blocks."
-            transformer_keys = sorted(list(filter(lambda a: a.startswith(transformer_prefix), state_dict_keys)))
-            if len(transformer_keys) > 0:
+            if has_prefix(state_dict_keys, transformer_prefix):
                 last_transformer_depth = count_blocks(state_dict_keys, transformer_prefix + '{}')
                 if context_dim is None:
                     context_dim = state_dict['{}0.attn2.to_k.weight'.format(transformer_prefix)].shape[1]
@@ -172,3 +184,139 @@ def model_config_from_diffusers_unet(state_dict, use_fp16):
         if matches:
             return model_config_from_unet_config(unet_config)
     return None
+
+def get_model_config_class(name):
+    for model_config in supported_models.models:
+        if model_config.__name__ == name:
+            return model_config
+    return None
+
+class DetectionCache:
+    """
+    Index of the detected model type of checkpoint files, keyed by the absolute path and checked
+    against the size and mtime of the file so a replaced file gets detected again. It is only kept
+    in memory unless the path of a json file is given: the new entries are then written to it in
+    batches, SAVE_DELAY seconds after the first one and on exit, merged with the entries other
+    processes using the same file wrote in the meantime.
+    """
+    SAVE_DELAY = 10.0
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.new_entries = {}
+        self.save_timer = None
+        self.mutex = threading.Lock()
+        if path is not None:
+            self.entries = self.read()
+            atexit.register(self.save)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except Exception as e:
+            print("Error loading the model detection cache {}: {}".format(self.path, e))
+        return {}
+
+    def get_fingerprint(self, ckpt_path):
+        stat = os.stat(ckpt_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get(self, ckpt_path):
+        entry = self.entries.get(os.path.abspath(ckpt_path), None)
+        if entry is None or entry["fingerprint"] != self.get_fingerprint(ckpt_path):
+            return None
+        return entry
+
+    def put(self, ckpt_path, entry):
+        entry = dict(entry, fingerprint=self.get_fingerprint(ckpt_path))
+        with self.mutex:
+            self.entries[os.path.abspath(ckpt_path)] = entry
+            if self.path is None:
+                return
+            self.new_entries[os.path.abspath(ckpt_path)] = entry
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(self.SAVE_DELAY, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def save(self):
+        with self.mutex:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            if len(self.new_entries) == 0:
+                return
+            entries = self.read()
+            entries.update(self.new_entries)
+            try:
+                temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(entries, f)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                #kept in new_entries so they are written with the next ones
+                print("Error saving the model detection cache {}: {}".format(self.path, e))
+                return
+            self.new_entries = {}
+            self.entries.update(entries)
+
+detection_cache = DetectionCache(args.model_detection_cache if args.model_detection_cache else None)
+
+def detect_checkpoint(ckpt_path, state_dict=None, unet_key_prefix="model.diffusion_model.", header=None):
+    """
+    Detects the model type of a checkpoint from the detection cache, from state_dict or from the
+    header of a safetensors file (header is the result of utils.load_safetensors_meta if the caller
+    already has it). Returns a dict with the name of the model config class (None if it isn't a
+    supported model), the unet config without use_fp16 and the number of unet parameters, or None
+    when it needs the full state dict of the file.
+    """
+    entry = detection_cache.get(ckpt_path)
+    if entry is not None:
+        return entry
+
+    from_header = state_dict is None
+    if state_dict is None:
+        state_dict = header if header is not None else utils.load_safetensors_meta(ckpt_path)
+        if state_dict is None:
+            return None
+
+    cache = True
+    parameters = 0
+    try:
+        for k in state_dict:
+            if k.startswith(unet_key_prefix):
+                parameters += state_dict[k].nelement()
+        unet_config = detect_unet_config(state_dict, unet_key_prefix, False)
+        model_config = model_config_from_unet_config(dict(unet_config))
+    except (KeyError, IndexError):
+        unet_config = None
+        model_config = None
+    except Exception as e:
+        if from_header:
+            print("Could not detect the model type of {} from its header, detecting it from the state dict: {}".format(ckpt_path, e))
+            return None
+        print("Could not detect the model type of {}: {}".format(ckpt_path, e))
+        unet_config = None
+        model_config = None
+        cache = False
+
+    if unet_config is not None:
+        unet_config.pop("use_fp16")
+    entry = {"model_config": type(model_config).__name__ if model_config is not None else None, "unet_config": unet_config, "parameters": parameters}
+    if cache:
+        detection_cache.put(ckpt_path, entry)
+    return entry
+
+def model_config_from_detection(entry, use_fp16):
+    model_config = get_model_config_class(entry["model_config"])
+    if model_config is None:
+        return None
+    unet_config = dict(entry["unet_config"])
+    unet_config["use_fp16"] = use_fp16
+    return model_config(unet_config)
@@ -1,4 +1,6 @@
 import psutil
+import threading
+import time
 from enum import Enum
 from comfy.cli_args import args
 import torch
@@ -221,96 +223,200 @@ except:
     print("Could not pick default device.")
 
 
-current_loaded_model = None
-current_gpu_controlnets = []
+class LoadedModel:
+    """
+    A ModelPatcher loaded on its load device, the patches are applied to the weights while it is loaded.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.device = model.load_device
+        self.model_accelerated = False
 
-model_accelerated = False
+    def model_memory(self):
+        return self.model.model_size()
 
+    def is_module(self, module):
+        return self.model.model is module
 
-def unload_model():
-    global current_loaded_model
-    global model_accelerated
-    global current_gpu_controlnets
-    global vram_state
+    def model_load(self, lowvram_model_memory=0):
+        patch_model_to = None
+        if lowvram_model_memory == 0:
+            patch_model_to = self.device
 
-    if current_loaded_model is not None:
-        if model_accelerated:
-            accelerate.hooks.remove_hook_from_submodules(current_loaded_model.model)
-            model_accelerated = False
+        self.model.model_patches_to(self.device)
+        self.model.model_patches_to(self.model.model_dtype())
 
-        current_loaded_model.unpatch_model()
-        current_loaded_model.model.to(current_loaded_model.offload_device)
-        current_loaded_model.model_patches_to(current_loaded_model.offload_device)
-        current_loaded_model = None
-        if vram_state != VRAMState.HIGH_VRAM:
-            soft_empty_cache()
+        try:
+            self.real_model = self.model.patch_model(device_to=patch_model_to)
+        except Exception as e:
+            self.model.unpatch_model()
+            self.model_unload()
+            raise e
+
+        if lowvram_model_memory > 0:
+            device_map = accelerate.infer_auto_device_map(self.real_model, max_memory={0: "{}MiB".format(lowvram_model_memory // (1024 * 1024)), "cpu": "16GiB"})
+            accelerate.dispatch_model(self.real_model, device_map=device_map, main_device=self.device)
+            self.model_accelerated = True
+        elif patch_model_to is not None:
+            self.real_model.to(self.device)
+        return self.real_model
+
+    def model_unload(self):
+        if self.model_accelerated:
+            accelerate.hooks.remove_hook_from_submodules(self.real_model)
+            self.model_accelerated = False
+
+        self.model.unpatch_model()
+        self.model.model.to(self.model.offload_device)
+        self.model.model_patches_to(self.model.offload_device)
+
+class LoadedModule:
+    """
+    A plain torch module like a VAE or a controlnet loaded on a device.
+    """
+    def __init__(self, model, device, offload_device):
+        self.model = model
+        self.device = device
+        self.offload_device = offload_device
+        self.size = 0
+
+    def model_memory(self):
+        if self.size == 0:
+            self.size = sum(t.nelement() * t.element_size() for t in self.model.state_dict().values())
+        return self.size
+
+    def is_module(self, module):
+        return self.model is module
+
+    def model_load(self, lowvram_model_memory=0):
+        return self.model.to(self.device)
+
+    def model_unload(self):
+        self.model.to(self.offload_device)
+
+#the models on a device, the most recently used first
+current_loaded_models = []
+
+def unload_model_index(i):
+    loaded = current_loaded_models.pop(i)
+    loaded.model_unload()
+
+def free_memory(memory_required, device, keep_loaded=[]):
+    """
+    Unloads the least recently used models on device until at least memory_required bytes are free.
+    """
+    unloaded = False
+    for i in range(len(current_loaded_models) - 1, -1, -1):
+        if get_free_memory(device) > memory_required:
+            break
+        loaded = current_loaded_models[i]
+        if loaded.device == device and loaded.model not in keep_loaded:
+            unload_model_index(i)
+            unloaded = True
+
+    if unloaded and vram_state != VRAMState.HIGH_VRAM:
+        soft_empty_cache()
 
+def unload_model():
+    #unloads every model, for the code that needs the whole device memory
+    while len(current_loaded_models) > 0:
+        unload_model_index(-1)
     if vram_state != VRAMState.HIGH_VRAM:
-        if len(current_gpu_controlnets) > 0:
-            for n in current_gpu_controlnets:
-                n.cpu()
-            current_gpu_controlnets = []
+        soft_empty_cache()
 
 def minimum_inference_memory():
     return (768 * 1024 * 1024)
 
-def load_model_gpu(model):
-    global current_loaded_model
-    global vram_state
-    global model_accelerated
+model_load_time = threading.local()
 
-    if model is current_loaded_model:
-        return
-    unload_model()
+def get_model_load_time():
+    #total time this thread has spent in load_model_gpu, used to profile nodes
+    return getattr(model_load_time, "total", 0.0)
 
+def load_model_gpu(model):
+    start_time = time.perf_counter()
+    try:
+        return load_model_gpu_(model)
+    finally:
+        model_load_time.total = get_model_load_time() + (time.perf_counter() - start_time)
+
+def use_loaded(loaded, memory_required, keep_loaded):
+    #moves an already loaded model to the front, returns None if it has to be loaded
+    for i in range(len(current_loaded_models)):
+        if current_loaded_models[i].model is loaded:
+            current_loaded_models.insert(0, current_loaded_models.pop(i))
+            free_memory(memory_required, current_loaded_models[0].device, keep_loaded=keep_loaded)
+            return current_loaded_models[0]
+    return None
+
+def unload_same_module(module):
+    #a different patcher of the same model or a model loaded with another device: the weights are shared so it has to go
+    for i in range(len(current_loaded_models) - 1, -1, -1):
+        if current_loaded_models[i].is_module(module):
+            unload_model_index(i)
+
+def load_model_gpu_(model):
+    loaded = use_loaded(model, minimum_inference_memory(), [model])
+    if loaded is not None:
+        return model
+
+    unload_same_module(model.model)
+    loaded = LoadedModel(model)
     torch_dev = model.load_device
-    model.model_patches_to(torch_dev)
-    model.model_patches_to(model.model_dtype())
-    current_loaded_model = model
 
     if is_device_cpu(torch_dev):
         vram_set_state = VRAMState.DISABLED
     else:
         vram_set_state = vram_state
 
+    model_size = loaded.model_memory()
+    if vram_set_state != VRAMState.DISABLED:
+        free_memory(model_size + minimum_inference_memory(), torch_dev)
+    else:
+        #free_memory never unloads the models loaded on the cpu, only the last one stays loaded so they don't pile up
+        for i in range(len(current_loaded_models) - 1, -1, -1):
+            if is_device_cpu(current_loaded_models[i].device):
+                unload_model_index(i)
+
+    lowvram_model_memory = 0
     if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM):
-        model_size = model.model_size()
         current_free_mem = get_free_memory(torch_dev)
         lowvram_model_memory = int(max(256 * (1024 * 1024), (current_free_mem - 1024 * (1024 * 1024)) / 1.3 ))
         if model_size > (current_free_mem - minimum_inference_memory()): #only switch to lowvram if really necessary
             vram_set_state = VRAMState.LOW_VRAM
 
-    real_model = model.model
-    patch_model_to = None
-    if vram_set_state == VRAMState.DISABLED:
-        pass
-    elif vram_set_state == VRAMState.NORMAL_VRAM or vram_set_state == VRAMState.HIGH_VRAM or vram_set_state == VRAMState.SHARED:
-        model_accelerated = False
-        patch_model_to = torch_dev
-
-    try:
-        real_model = model.patch_model(device_to=patch_model_to)
-    except Exception as e:
-        model.unpatch_model()
-        unload_model()
-        raise e
+    if vram_set_state == VRAMState.NO_VRAM:
+        lowvram_model_memory = 256 * 1024 * 1024
+    elif vram_set_state != VRAMState.LOW_VRAM:
+        lowvram_model_memory = 0
 
-    if patch_model_to is not None:
-        real_model.to(torch_dev)
+    loaded.model_load(lowvram_model_memory)
+    current_loaded_models.insert(0, loaded)
+    return model
 
-    if vram_set_state == VRAMState.NO_VRAM:
-        device_map = accelerate.infer_auto_device_map(real_model, max_memory={0: "256MiB", "cpu": "16GiB"})
-        accelerate.dispatch_model(real_model, device_map=device_map, main_device=torch_dev)
-        model_accelerated = True
-    elif vram_set_state == VRAMState.LOW_VRAM:
-        device_map = accelerate.infer_auto_device_map(real_model, max_memory={0: "{}MiB".format(lowvram_model_memory // (1024 * 1024)), "cpu": "16GiB"})
-        accelerate.dispatch_model(real_model, device_map=device_map, main_device=torch_dev)
-        model_accelerated = True
-
-    return current_loaded_model
-
-def load_controlnet_gpu(control_models):
-    global current_gpu_controlnets
+def load_module_gpu(module, device, offload_device, memory_required=0, keep_loaded=[]):
+    """
+    Loads a torch module (VAE, controlnet...) on device, it counts against the same memory as the
+    models loaded with load_model_gpu and stays loaded until the memory is needed for something else.
+    memory_required is the memory needed to run it on top of its weights, the models in keep_loaded
+    are not unloaded to make room for it.
+    """
+    if device == offload_device:
+        return module.to(device)
+    keep_loaded = list(keep_loaded) + [module]
+    loaded = use_loaded(module, memory_required, keep_loaded)
+    if loaded is not None:
+        return module
+
+    unload_same_module(module)
+    loaded = LoadedModule(module, device, offload_device)
+    free_memory(loaded.model_memory() + memory_required, device, keep_loaded=keep_loaded)
+    loaded.model_load()
+    current_loaded_models.insert(0, loaded)
+    return module
+
+def load_controlnet_gpu(control_models, keep_loaded=[]):
+    #keep_loaded are the models the controlnets are used with, they are not unloaded to make room for them
     global vram_state
     if vram_state == VRAMState.DISABLED:
         return
@@ -326,14 +432,9 @@ def load_controlnet_gpu(control_models):
     for m in control_models:
         models += m.get_models()
 
-    for m in current_gpu_controlnets:
-        if m not in models:
-            m.cpu()
-
     device = get_torch_device()
-    current_gpu_controlnets = []
     for m in models:
-        current_gpu_controlnets.append(m.to(device))
+        load_module_gpu(m, device, torch.device("cpu"), memory_required=minimum_inference_memory(), keep_loaded=list(keep_loaded) + models)
 
 
 def load_if_low_vram(model):
@@ -542,6 +643,27 @@ def should_use_fp16(device=None, model_params=0):
 
     return True
 
+current_process = psutil.Process()
+
+def get_process_memory():
+    return current_process.memory_info().rss
+
+def torch_memory_stats_available():
+    return cpu_state == CPUState.GPU and not directml_enabled and not xpu_available and torch.cuda.is_available()
+
+def reset_peak_memory(dev=None):
+    if torch_memory_stats_available():
+        if dev is None:
+            dev = get_torch_device()
+        torch.cuda.reset_peak_memory_stats(dev)
+
+def get_peak_memory(dev=None):
+    if torch_memory_stats_available():
+        if dev is None:
+            dev = get_torch_device()
+        return torch.cuda.max_memory_allocated(dev)
+    return None
+
 def soft_empty_cache():
     global xpu_available
     global cpu_state
@@ -51,13 +51,13 @@ def get_models_from_cond(cond, model_type):
             models += [c[1][model_type]]
     return models
 
-def load_additional_models(positive, negative, dtype):
-    """loads additional models in positive and negative conditioning"""
+def load_additional_models(positive, negative, dtype, keep_loaded=[]):
+    """loads additional models in positive and negative conditioning, without unloading the models in keep_loaded"""
     control_nets = get_models_from_cond(positive, "control") + get_models_from_cond(negative, "control")
     gligen = get_models_from_cond(positive, "gligen") + get_models_from_cond(negative, "gligen")
     gligen = [x[1].to(dtype) for x in gligen]
     models = control_nets + gligen
-    comfy.model_management.load_controlnet_gpu(models)
+    comfy.model_management.load_controlnet_gpu(models, keep_loaded=keep_loaded)
     return models
 
 def cleanup_additional_models(models):
@@ -81,7 +81,7 @@ def sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative
     positive_copy = broadcast_cond(positive, noise.shape[0], device)
     negative_copy = broadcast_cond(negative, noise.shape[0], device)
 
-    models = load_additional_models(positive, negative, model.model_dtype())
+    models = load_additional_models(positive, negative, model.model_dtype(), keep_loaded=[model])
 
     sampler = comfy.samplers.KSampler(real_model, steps=steps, device=device, sampler=sampler_name, scheduler=scheduler, denoise=denoise, model_options=model.model_options)
 
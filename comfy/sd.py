@@ -22,7 +22,7 @@ from . import sd2_clip
 from . import sdxl_clip
 
 def load_model_weights(model, sd):
-    m, u = model.load_state_dict(sd, strict=False)
+    m, u = utils.load_state_dict(model, sd, strict=False)
     m = set(m)
     unexpected_keys = set(u)
 
@@ -576,7 +576,7 @@ class VAE:
             sd = utils.load_torch_file(ckpt_path)
             if 'decoder.up_blocks.0.resnets.0.norm1.weight' in sd.keys(): #diffusers format
                 sd = diffusers_convert.convert_vae_state_dict(sd)
-            self.first_stage_model.load_state_dict(sd, strict=False)
+            utils.load_state_dict(self.first_stage_model, sd, strict=False)
 
         if device is None:
             device = model_management.vae_device()
@@ -613,11 +613,11 @@ class VAE:
         return samples
 
     def decode(self, samples_in):
-        model_management.unload_model()
-        self.first_stage_model = self.first_stage_model.to(self.device)
+        memory_used = 2562 * samples_in.shape[2] * samples_in.shape[3] * 64
+        model_management.load_module_gpu(self.first_stage_model, self.device, self.offload_device, memory_required=memory_used)
         try:
             free_memory = model_management.get_free_memory(self.device)
-            batch_number = int((free_memory * 0.7) / (2562 * samples_in.shape[2] * samples_in.shape[3] * 64))
+            batch_number = int((free_memory * 0.7) / memory_used)
             batch_number = max(1, batch_number)
 
             pixel_samples = torch.empty((samples_in.shape[0], 3, round(samples_in.shape[2] * 8), round(samples_in.shape[3] * 8)), device="cpu")
@@ -628,24 +628,21 @@ class VAE:
             print("Warning: Ran out of memory when regular VAE decoding, retrying with tiled VAE decoding.")
             pixel_samples = self.decode_tiled_(samples_in)
 
-        self.first_stage_model = self.first_stage_model.to(self.offload_device)
         pixel_samples = pixel_samples.cpu().movedim(1,-1)
         return pixel_samples
 
     def decode_tiled(self, samples, tile_x=64, tile_y=64, overlap = 16):
-        model_management.unload_model()
-        self.first_stage_model = self.first_stage_model.to(self.device)
+        model_management.load_module_gpu(self.first_stage_model, self.device, self.offload_device, memory_required=2562 * tile_x * tile_y * 64 * 2)
         output = self.decode_tiled_(samples, tile_x, tile_y, overlap)
-        self.first_stage_model = self.first_stage_model.to(self.offload_device)
         return output.movedim(1,-1)
 
     def encode(self, pixel_samples):
-        model_management.unload_model()
-        self.first_stage_model = self.first_stage_model.to(self.device)
         pixel_samples = pixel_samples.movedim(-1,1)
+        memory_used = 2078 * pixel_samples.shape[2] * pixel_samples.shape[3]
+        model_management.load_module_gpu(self.first_stage_model, self.device, self.offload_device, memory_required=memory_used)
         try:
             free_memory = model_management.get_free_memory(self.device)
-            batch_number = int((free_memory * 0.7) / (2078 * pixel_samples.shape[2] * pixel_samples.shape[3])) #NOTE: this constant along with the one in the decode above are estimated from the mem usage for the VAE and could change.
+            batch_number = int((free_memory * 0.7) / memory_used) #NOTE: this constant along with the one in the decode above are estimated from the mem usage for the VAE and could change.
             batch_number = max(1, batch_number)
             samples = torch.empty((pixel_samples.shape[0], 4, round(pixel_samples.shape[2] // 8), round(pixel_samples.shape[3] // 8)), device="cpu")
             for x in range(0, pixel_samples.shape[0], batch_number):
@@ -656,15 +653,12 @@ class VAE:
             print("Warning: Ran out of memory when regular VAE encoding, retrying with tiled VAE encoding.")
             samples = self.encode_tiled_(pixel_samples)
 
-        self.first_stage_model = self.first_stage_model.to(self.offload_device)
         return samples
 
     def encode_tiled(self, pixel_samples, tile_x=512, tile_y=512, overlap = 64):
-        model_management.unload_model()
-        self.first_stage_model = self.first_stage_model.to(self.device)
+        model_management.load_module_gpu(self.first_stage_model, self.device, self.offload_device, memory_required=2078 * tile_x * tile_y * 2)
         pixel_samples = pixel_samples.movedim(-1,1)
         samples = self.encode_tiled_(pixel_samples, tile_x=tile_x, tile_y=tile_y, overlap=overlap)
-        self.first_stage_model = self.first_stage_model.to(self.offload_device)
         return samples
 
     def get_sd(self):
@@ -901,9 +895,9 @@ def load_controlnet(ckpt_path, model=None):
             pass
         w = WeightsLoader()
         w.control_model = control_model
-        missing, unexpected = w.load_state_dict(controlnet_data, strict=False)
+        missing, unexpected = utils.load_state_dict(w, controlnet_data, strict=False)
     else:
-        missing, unexpected = control_model.load_state_dict(controlnet_data, strict=False)
+        missing, unexpected = utils.load_state_dict(control_model, controlnet_data, strict=False)
     print(missing, unexpected)
 
     if use_fp16:
@@ -1159,32 +1153,66 @@ def calculate_parameters(sd, prefix):
             params += sd[k].nelement()
     return params
 
-def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None):
-    sd = utils.load_torch_file(ckpt_path)
-    sd_keys = sd.keys()
+def get_checkpoint_keys(sd, model_config, output_model=True, output_vae=True, output_clip=True, output_clipvision=False):
+    #the keys of the requested parts of a checkpoint, the clip is what doesn't belong to the other parts
+    #and the top level keys like v_pred are always included
+    unet_prefix = "model.diffusion_model."
+    vae_prefix = "first_stage_model."
+    clip_vision_prefix = model_config.clip_vision_prefix
+    other_prefixes = (unet_prefix, vae_prefix, "model_ema.") + ((clip_vision_prefix,) if clip_vision_prefix is not None else ())
+    keys = []
+    for k in sd:
+        if "." not in k:
+            keys.append(k)
+        elif k.startswith(unet_prefix):
+            if output_model:
+                keys.append(k)
+        elif k.startswith(vae_prefix):
+            if output_vae:
+                keys.append(k)
+        elif clip_vision_prefix is not None and k.startswith(clip_vision_prefix):
+            if output_clipvision:
+                keys.append(k)
+        elif output_clip and not k.startswith(other_prefixes):
+            keys.append(k)
+    return keys
+
+def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True):
+    #safetensors checkpoints are detected from their header (or the detection cache) before anything
+    #is loaded so only the parts that were asked for get loaded
+    sd = None
+    header = utils.load_safetensors_meta(ckpt_path)
+    detected = model_detection.detect_checkpoint(ckpt_path, header=header)
+    if detected is None or header is None:
+        sd = utils.load_torch_file(ckpt_path)
+        if detected is None:
+            detected = model_detection.detect_checkpoint(ckpt_path, sd)
     clip = None
     clipvision = None
     vae = None
     model = None
     clip_target = None
 
-    parameters = calculate_parameters(sd, "model.diffusion_model.")
-    fp16 = model_management.should_use_fp16(model_params=parameters)
+    fp16 = model_management.should_use_fp16(model_params=detected["parameters"])
 
     class WeightsLoader(torch.nn.Module):
         pass
 
-    model_config = model_detection.model_config_from_unet(sd, "model.diffusion_model.", fp16)
+    model_config = model_detection.model_config_from_detection(detected, fp16)
     if model_config is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
 
+    if sd is None:
+        sd = utils.load_torch_file(ckpt_path, keys=get_checkpoint_keys(header, model_config, output_model, output_vae, output_clip, output_clipvision))
+
     if model_config.clip_vision_prefix is not None:
         if output_clipvision:
             clipvision = clip_vision.load_clipvision_from_sd(sd, model_config.clip_vision_prefix, True)
 
     offload_device = model_management.unet_offload_device()
-    model = model_config.get_model(sd, "model.diffusion_model.", device=offload_device)
-    model.load_model_weights(sd, "model.diffusion_model.")
+    if output_model:
+        model = model_config.get_model(sd, "model.diffusion_model.", device=offload_device)
+        model.load_model_weights(sd, "model.diffusion_model.")
 
     if output_vae:
         vae = VAE()
@@ -1204,7 +1232,10 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
     if len(left_over) > 0:
         print("left over keys:", left_over)
 
-    return (ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae, clipvision)
+    model_patcher = None
+    if model is not None:
+        model_patcher = ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device)
+    return (model_patcher, clip, vae, clipvision)
 
 
 def load_unet(unet_path): #load unet in diffusers format
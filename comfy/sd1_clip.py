@@ -2,6 +2,7 @@ import os
 
 from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextConfig, modeling_utils
 import comfy.ops
+import comfy.utils
 import torch
 import traceback
 import zipfile
@@ -161,7 +162,7 @@ class SD1ClipModel(torch.nn.Module, ClipTokenWeightEncoder):
         return self(tokens)
 
     def load_sd(self, sd):
-        return self.transformer.load_state_dict(sd, strict=False)
+        return comfy.utils.load_state_dict(self.transformer, sd, strict=False)
 
 def parse_parentheses(string):
     result = []
@@ -1,14 +1,218 @@
 import torch
 import math
 import struct
+import json
+import mmap
+import os
+import threading
+import collections
+import contextlib
+import inspect
 import comfy.checkpoint_pickle
+import safetensors
 import safetensors.torch
+from comfy.cli_args import args
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+#only in the torch versions that have them
+for dtype_name, torch_dtype_name in [("F8_E4M3", "float8_e4m3fn"), ("F8_E5M2", "float8_e5m2"), ("U16", "uint16"), ("U32", "uint32"), ("U64", "uint64")]:
+    if hasattr(torch, torch_dtype_name):
+        SAFETENSORS_DTYPES[dtype_name] = getattr(torch, torch_dtype_name)
+
+def load_safetensors_mmap(ckpt, keys=None):
+    #the tensors point into a copy on write map of the file: the pages are shared with the OS file cache
+    #and with the other processes mapping the same file until a tensor gets modified
+    #returns None if the file has tensors of a dtype that isn't in SAFETENSORS_DTYPES
+    with open(ckpt, "rb") as f:
+        length_of_header = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length_of_header))
+        if keys is None:
+            keys = [k for k in header.keys() if k != "__metadata__"]
+        else:
+            keys = [k for k in keys if k != "__metadata__" and k in header]
+        if any(header[k]["dtype"] not in SAFETENSORS_DTYPES for k in keys):
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + length_of_header
+    sd = {}
+    for k in keys:
+        v = header[k]
+        dtype = SAFETENSORS_DTYPES[v["dtype"]]
+        start, end = v["data_offsets"]
+        count = (end - start) // torch.tensor([], dtype=dtype).element_size()
+        if count == 0:
+            sd[k] = torch.empty(v["shape"], dtype=dtype)
+        else:
+            sd[k] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start).reshape(v["shape"])
+    return sd
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+def load_safetensors_meta(ckpt):
+    """
+    State dict of meta tensors built from the header of a safetensors file: the keys, shapes and dtypes
+    without reading any weights. Returns None for other files and for files with tensors of a dtype
+    that isn't in SAFETENSORS_DTYPES, those have to be loaded.
+    """
+    if not ckpt.lower().endswith(".safetensors"):
+        return None
+    header = safetensors_header(ckpt)
+    if header is None:
+        return None
+    sd = {}
+    for k, v in json.loads(header).items():
+        if k == "__metadata__":
+            continue
+        if v["dtype"] not in SAFETENSORS_DTYPES:
+            return None
+        sd[k] = torch.empty(v["shape"], dtype=SAFETENSORS_DTYPES[v["dtype"]], device="meta")
+    return sd
+
+def use_mmap():
+    return args.mmap_models or args.workers > 1
+
+class StateDictCache:
+    """
+    LRU cache of the state dicts loaded from model files, keyed by (absolute path, size, mtime)
+    so a file that gets replaced is loaded again. An entry can hold only part of the keys of a
+    file when they were loaded separately. State dicts bigger than size_budget bytes are not cached.
+    """
+    def __init__(self, size_budget):
+        self.size_budget = size_budget
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.mutex = threading.Lock()
+        self.loads = {}
+
+    def get_key(self, ckpt):
+        path = os.path.abspath(ckpt)
+        stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, key, keys=None):
+        #the tensors of keys (all of them if None), None if they aren't all cached
+        with self.mutex:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            sd, size, complete = entry
+            if keys is None:
+                if not complete:
+                    return None
+                keys = sd.keys()
+            elif not complete and any(k not in sd for k in keys):
+                return None
+            self.entries.move_to_end(key)
+            #the loaders add and remove keys so they each get their own dict, the tensors are shared
+            return {k: sd[k] for k in keys if k in sd}
+
+    def put(self, key, sd, complete=True):
+        with self.mutex:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+                merged = dict(old[0])
+                merged.update(sd)
+                sd = merged
+                complete = complete or old[2]
+            #an older version of the same file won't be asked for again
+            for k in [k for k in self.entries if k[0] == key[0]]:
+                self.size -= self.entries.pop(k)[1]
+
+            size = 0
+            for v in sd.values():
+                if isinstance(v, torch.Tensor):
+                    size += v.nelement() * v.element_size()
+            if size > self.size_budget:
+                return
+            self.entries[key] = (dict(sd), size, complete)
+            self.size += size
+            while self.size > self.size_budget:
+                _, (_, removed_size, _) = self.entries.popitem(last=False)
+                self.size -= removed_size
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.size = 0
+
+    @contextlib.contextmanager
+    def loading(self, key):
+        #held while the file of key is loaded, a second load of the same file waits for it and then gets it from the cache
+        with self.mutex:
+            lock, users = self.loads.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self.loads[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self.mutex:
+                lock, users = self.loads[key]
+                if users == 1:
+                    self.loads.pop(key)
+                else:
+                    self.loads[key] = (lock, users - 1)
+
+    def is_loading(self, key):
+        with self.mutex:
+            return key in self.loads
+
+state_dict_cache = StateDictCache(int(args.state_dict_cache_size * 1024 * 1024 * 1024))
+
+def load_torch_file(ckpt, safe_load=False, device=None, keys=None):
+    """
+    Loads the state dict of a model file, the ones loaded to the cpu go through state_dict_cache
+    so every loader node asking for the same file gets the same tensors. With keys only those
+    tensors are loaded, for safetensors files the rest of the file isn't read.
+    """
     if device is None:
         device = torch.device("cpu")
+    if keys is not None and not ckpt.lower().endswith(".safetensors"):
+        #the whole file has to be read anyway
+        sd = load_torch_file(ckpt, safe_load, device)
+        return {k: sd[k] for k in keys if k in sd}
+
+    if device.type != "cpu" or state_dict_cache.size_budget <= 0:
+        return load_torch_file_(ckpt, safe_load, device, keys)
+
+    cache_key = state_dict_cache.get_key(ckpt)
+    with state_dict_cache.loading(cache_key):
+        sd = state_dict_cache.get(cache_key, keys)
+        if sd is not None:
+            return sd
+        sd = load_torch_file_(ckpt, safe_load, device, keys)
+        if isinstance(sd, dict):
+            state_dict_cache.put(cache_key, sd, complete=keys is None)
+    return sd
+
+def load_torch_file_(ckpt, safe_load, device, keys=None):
     if ckpt.lower().endswith(".safetensors"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        if device.type == "cpu" and use_mmap():
+            sd = load_safetensors_mmap(ckpt, keys)
+            if sd is not None:
+                return sd
+        if keys is not None:
+            sd = {}
+            with safetensors.safe_open(ckpt, framework="pt", device=device.type) as f:
+                file_keys = set(f.keys())
+                for k in keys:
+                    if k in file_keys:
+                        sd[k] = f.get_tensor(k)
+        else:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
@@ -26,6 +230,28 @@ def load_torch_file(ckpt, safe_load=False, device=None):
             sd = pl_sd
     return sd
 
+STATE_DICT_ASSIGN = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+def load_state_dict(module, sd, strict=False):
+    """
+    Like module.load_state_dict but the parameters take the tensors of sd instead of getting a copy of them
+    when they already have the right dtype and device, a memory mapped state dict then ends up as the weights
+    of the model without being read into new memory.
+    """
+    if not STATE_DICT_ASSIGN:
+        return module.load_state_dict(sd, strict=strict)
+
+    module_sd = module.state_dict()
+    to_load = {}
+    for k in sd:
+        v = sd[k]
+        current = module_sd.get(k, None)
+        if current is not None and isinstance(v, torch.Tensor):
+            v = v.to(device=current.device, dtype=current.dtype)
+        to_load[k] = v
+    del module_sd
+    return module.load_state_dict(to_load, strict=strict, assign=True)
+
 def save_torch_file(sd, ckpt, metadata=None):
     if metadata is not None:
         safetensors.torch.save_file(sd, ckpt, metadata=metadata)
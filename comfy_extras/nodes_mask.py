@@ -70,6 +70,7 @@ class MaskToImage:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "mask_to_image"
+    THREAD_SAFE = True
 
     def mask_to_image(self, mask):
         result = mask.reshape((-1, 1, mask.shape[-2], mask.shape[-1])).movedim(1, -1).expand(-1, -1, -1, 3)
@@ -89,6 +90,7 @@ class ImageToMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "image_to_mask"
+    THREAD_SAFE = True
 
     def image_to_mask(self, image, channel):
         channels = ["red", "green", "blue"]
@@ -111,6 +113,7 @@ class SolidMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "solid"
+    THREAD_SAFE = True
 
     def solid(self, value, width, height):
         out = torch.full((height, width), value, dtype=torch.float32, device="cpu")
@@ -130,6 +133,7 @@ class InvertMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "invert"
+    THREAD_SAFE = True
 
     def invert(self, mask):
         out = 1.0 - mask
@@ -153,6 +157,7 @@ class CropMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "crop"
+    THREAD_SAFE = True
 
     def crop(self, mask, x, y, width, height):
         out = mask[y:y + height, x:x + width]
@@ -176,6 +181,7 @@ class MaskComposite:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "combine"
+    THREAD_SAFE = True
 
     def combine(self, destination, source, x, y, operation):
         output = destination.clone()
@@ -222,6 +228,7 @@ class FeatherMask:
     RETURN_TYPES = ("MASK",)
 
     FUNCTION = "feather"
+    THREAD_SAFE = True
 
     def feather(self, mask, left, top, right, bottom):
         output = mask.clone()
@@ -6,14 +6,48 @@ import threading
 import heapq
 import traceback
 import gc
+import math
+import itertools
+import time
+import collections
+import concurrent.futures
 
 import torch
 import nodes
 
 import comfy.model_management
+import execution_cache
+import history_store
+import queue_journal
+import prompt_scheduler
+import model_prefetch
+import folder_paths
+from comfy.cli_args import args
+
+input_types_cache = {}
+input_types_folder_state = None
+
+def refresh_input_types():
+    # checking the folders stats each of them so it is done once per prompt validation or execution instead of every get_input_types call
+    global input_types_folder_state
+    input_types_folder_state = folder_paths.get_folder_state()
+    return input_types_folder_state
+
+def get_input_types(class_def):
+    # INPUT_TYPES often lists folders so it only gets called again when their content changes
+    folder_state = input_types_folder_state
+    if folder_state is None:
+        folder_state = refresh_input_types()
+    # read once with get since the executor thread and the event loop both use the cache
+    cached = input_types_cache.get(class_def, None)
+    if cached is not None and cached[0] == folder_state:
+        return cached[1]
+    input_types = class_def.INPUT_TYPES()
+    input_types_cache[class_def] = (folder_state, input_types)
+    return input_types
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
-    valid_inputs = class_def.INPUT_TYPES()
+    valid_inputs = get_input_types(class_def)
     input_data_all = {}
     for x in inputs:
         input_data = inputs[x]
@@ -38,8 +72,24 @@ def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_da
                     input_data_all[x] = [extra_data['extra_pnginfo']]
             if h[x] == "UNIQUE_ID":
                 input_data_all[x] = [unique_id]
+
+    for x, value in get_lazy_output_inputs(prompt, unique_id, class_def).items():
+        input_data_all[x] = [value]
     return input_data_all
 
+def get_lazy_output_inputs(prompt, unique_id, class_def):
+    # LAZY_OUTPUTS maps output indexes of a node to an input that is set to False when nothing is
+    # linked to that output, so the node can skip computing it (loaders skip reading those weights)
+    lazy_outputs = getattr(class_def, "LAZY_OUTPUTS", None)
+    if lazy_outputs is None or len(prompt) == 0:
+        return {}
+    linked = set()
+    for node in prompt.values():
+        for v in node['inputs'].values():
+            if isinstance(v, list) and v[0] == unique_id:
+                linked.add(v[1])
+    return {x: False for index, x in lazy_outputs.items() if index not in linked}
+
 def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
     # check if node wants the lists
     input_is_list = False
@@ -116,45 +166,68 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
+def start_node_profile(measure_memory=True):
+    # the peak memory, rss and model load time are process wide so nodes running on the thread pool only get their wall time
+    if not measure_memory:
+        return (time.perf_counter(), None, None)
+    comfy.model_management.reset_peak_memory()
+    return (time.perf_counter(), comfy.model_management.get_model_load_time(), comfy.model_management.get_process_memory())
+
+def end_node_profile(class_type, start):
+    start_time, start_model_load_time, start_memory = start
+    profile = {
+        "class_type": class_type,
+        "cached": False,
+        "wall_time": time.perf_counter() - start_time,
+        "model_load_time": None,
+        "rss_delta": None,
+        "torch_peak_memory": None,
+    }
+    if start_memory is not None:
+        profile["model_load_time"] = comfy.model_management.get_model_load_time() - start_model_load_time
+        profile["rss_delta"] = comfy.model_management.get_process_memory() - start_memory
+        profile["torch_peak_memory"] = comfy.model_management.get_peak_memory()
+    return profile
+
+def prepare_node(prompt, outputs, unique_id, extra_data, object_storage, original_prompt=None):
+    # when prompt had its duplicate nodes merged the nodes still get the queued prompt as their hidden PROMPT input
+    if original_prompt is None:
+        original_prompt = prompt
     class_type = prompt[unique_id]['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
-    if unique_id in outputs:
-        return (True, None, None)
-
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
-
-    input_data_all = None
-    try:
-        input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
+    input_data_all = get_input_data(prompt[unique_id]['inputs'], class_def, unique_id, outputs, original_prompt, extra_data)
+    obj = object_storage.get((unique_id, class_type), None)
+    if obj is None:
+        obj = class_def()
+        object_storage[(unique_id, class_type)] = obj
+    return input_data_all, obj
+
+def run_node(obj, input_data_all, class_type, measure_memory=True):
+    # the part of executing a node that runs on the thread pool for thread safe nodes, it doesn't touch any shared state
+    profile_start = start_node_profile(measure_memory)
+    output_data, output_ui = get_output_data(obj, input_data_all)
+    return output_data, output_ui, end_node_profile(class_type, profile_start)
+
+def run_node_inference_mode(*args):
+    # inference mode is thread local so it has to be enabled again in the thread pool workers
+    with torch.inference_mode():
+        return run_node(*args, measure_memory=False)
+
+def finish_node(server, outputs, unique_id, executed, prompt_id, outputs_ui, profile, result):
+    output_data, output_ui, node_profile = result
+    outputs[unique_id] = output_data
+    if len(output_ui) > 0:
+        outputs_ui[unique_id] = output_ui
         if server.client_id is not None:
-            server.last_node_id = unique_id
-            server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
+            server.send_sync("executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }, server.client_id)
+    if profile is not None:
+        profile[unique_id] = node_profile
+        if server.client_id is not None:
+            server.send_sync("execution_profile", { "node": unique_id, "profile": node_profile, "prompt_id": prompt_id }, server.client_id)
+    executed.add(unique_id)
 
-        obj = object_storage.get((unique_id, class_type), None)
-        if obj is None:
-            obj = class_def()
-            object_storage[(unique_id, class_type)] = obj
-
-        output_data, output_ui = get_output_data(obj, input_data_all)
-        outputs[unique_id] = output_data
-        if len(output_ui) > 0:
-            outputs_ui[unique_id] = output_ui
-            if server.client_id is not None:
-                server.send_sync("executed", { "node": unique_id, "output": output_ui, "prompt_id": prompt_id }, server.client_id)
-    except comfy.model_management.InterruptProcessingException as iex:
+def node_error(unique_id, ex, input_data_all, outputs):
+    if isinstance(ex, comfy.model_management.InterruptProcessingException):
         print("Processing interrupted")
 
         # skip formatting inputs/outputs
@@ -162,114 +235,307 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             "node_id": unique_id,
         }
 
-        return (False, error_details, iex)
-    except Exception as ex:
-        typ, _, tb = sys.exc_info()
-        exception_type = full_type_name(typ)
-        input_data_formatted = {}
-        if input_data_all is not None:
-            input_data_formatted = {}
-            for name, inputs in input_data_all.items():
-                input_data_formatted[name] = [format_value(x) for x in inputs]
-
-        output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
-            output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
-
-        print("!!! Exception during processing !!!")
-        print(traceback.format_exc())
-
-        error_details = {
-            "node_id": unique_id,
-            "exception_message": str(ex),
-            "exception_type": exception_type,
-            "traceback": traceback.format_tb(tb),
-            "current_inputs": input_data_formatted,
-            "current_outputs": output_data_formatted
-        }
         return (False, error_details, ex)
 
-    executed.add(unique_id)
+    exception_type = full_type_name(type(ex))
+    input_data_formatted = {}
+    if input_data_all is not None:
+        input_data_formatted = {}
+        for name, inputs in input_data_all.items():
+            input_data_formatted[name] = [format_value(x) for x in inputs]
+
+    output_data_formatted = {}
+    for node_id, node_outputs in list(outputs.items()):
+        output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
+
+    print("!!! Exception during processing !!!")
+    print("".join(traceback.format_exception(type(ex), ex, ex.__traceback__)))
+
+    error_details = {
+        "node_id": unique_id,
+        "exception_message": str(ex),
+        "exception_type": exception_type,
+        "traceback": traceback.format_tb(ex.__traceback__),
+        "current_inputs": input_data_formatted,
+        "current_outputs": output_data_formatted
+    }
+    return (False, error_details, ex)
+
+def execute_node(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage, profile=None, original_prompt=None):
+    unique_id = current_item
+    class_type = prompt[unique_id]['class_type']
+    if unique_id in outputs:
+        return (True, None, None)
 
+    input_data_all = None
+    try:
+        input_data_all, obj = prepare_node(prompt, outputs, unique_id, extra_data, object_storage, original_prompt)
+        if server.client_id is not None:
+            server.last_node_id = unique_id
+            server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
+        result = run_node(obj, input_data_all, class_type)
+    except Exception as ex:
+        return node_error(unique_id, ex, input_data_all, outputs)
+
+    finish_node(server, outputs, unique_id, executed, prompt_id, outputs_ui, profile, result)
     return (True, None, None)
 
-def recursive_will_execute(prompt, outputs, current_item):
+def is_thread_safe(prompt, unique_id):
+    class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+    return getattr(class_def, "THREAD_SAFE", False) == True
+
+def get_linked_inputs(prompt, unique_id):
+    linked = []
+    for input_data in prompt[unique_id]['inputs'].values():
+        if isinstance(input_data, list):
+            linked.append(input_data[0])
+    return linked
+
+def get_topological_order(prompt, output_ids):
+    # iterative depth first search so deep graphs don't hit the recursion limit
+    order = []
+    state = {}
+    for output_id in output_ids:
+        if output_id in state:
+            continue
+        state[output_id] = "visiting"
+        stack = [(output_id, iter(get_linked_inputs(prompt, output_id)))]
+        while len(stack) > 0:
+            unique_id, linked = stack[-1]
+            for input_unique_id in linked:
+                if input_unique_id not in state:
+                    state[input_unique_id] = "visiting"
+                    stack.append((input_unique_id, iter(get_linked_inputs(prompt, input_unique_id))))
+                    break
+                elif state[input_unique_id] == "visiting":
+                    print("Warning: cycle in prompt between nodes {} and {}".format(unique_id, input_unique_id))
+            else:
+                stack.pop()
+                state[unique_id] = "done"
+                order.append(unique_id)
+    return order
+
+class ExecutionSchedule:
+    """
+    Dependency graph of the nodes that have to be executed for a prompt, built once per prompt.
+    A node is ready when all its uncached inputs have been executed. Ready nodes needed by the
+    output with the fewest nodes to execute are picked first.
+
+    If is_parallel is set, the ready nodes it returns True for are kept in a separate heap so
+    they can be handed to a thread pool, see pop_parallel.
+    """
+    def __init__(self, prompt, outputs, execute_outputs, is_parallel=None):
+        self.blocking = {}
+        self.dependents = {}
+        self.priority = {}
+        self.ready = []
+        self.ready_parallel = []
+        self.is_parallel = is_parallel
+
+        needed_by_output = []
+        for output_id in execute_outputs:
+            needed = set()
+            to_visit = [output_id]
+            while len(to_visit) > 0:
+                unique_id = to_visit.pop()
+                if unique_id in needed or unique_id in outputs:
+                    continue
+                needed.add(unique_id)
+                to_visit += get_linked_inputs(prompt, unique_id)
+            needed_by_output.append((len(needed), output_id, needed))
+
+        needed_by_output.sort(key=lambda a: (a[0], a[1]))
+        for rank, (_, _, needed) in enumerate(needed_by_output):
+            for unique_id in needed:
+                if unique_id not in self.priority:
+                    self.priority[unique_id] = rank
+
+        for unique_id in self.priority:
+            linked = set(filter(lambda a: a in self.priority, get_linked_inputs(prompt, unique_id)))
+            self.blocking[unique_id] = len(linked)
+            for input_unique_id in linked:
+                self.dependents.setdefault(input_unique_id, []).append(unique_id)
+
+        for unique_id in self.blocking:
+            if self.blocking[unique_id] == 0:
+                self.push_ready(unique_id)
+        self.remaining = len(self.priority)
+
+    def push_ready(self, unique_id):
+        if self.is_parallel is not None and self.is_parallel(unique_id):
+            heapq.heappush(self.ready_parallel, (self.priority[unique_id], unique_id))
+        else:
+            heapq.heappush(self.ready, (self.priority[unique_id], unique_id))
+
+    def is_empty(self):
+        return len(self.ready) == 0 and len(self.ready_parallel) == 0
+
+    def has_parallel(self):
+        return len(self.ready_parallel) > 0
+
+    def pop(self):
+        if len(self.ready) == 0:
+            return self.pop_parallel()
+        return heapq.heappop(self.ready)[1]
+
+    def pop_parallel(self):
+        return heapq.heappop(self.ready_parallel)[1]
+
+    def complete(self, unique_id):
+        self.remaining -= 1
+        for x in self.dependents.get(unique_id, []):
+            self.blocking[x] -= 1
+            if self.blocking[x] == 0:
+                self.push_ready(x)
+
+def get_seed_batch_key(item):
+    # prompts with the same key only differ by the seeds of their seed batchable nodes
+    prompt = item[2]
+    key = {}
+    for unique_id in prompt:
+        class_type = prompt[unique_id]['class_type']
+        inputs = prompt[unique_id]['inputs']
+        seed_input = getattr(nodes.NODE_CLASS_MAPPINGS[class_type], "SEED_BATCH_INPUT", None)
+        if seed_input is not None and seed_input in inputs and not isinstance(inputs[seed_input], list):
+            inputs = {x: inputs[x] for x in inputs if x != seed_input}
+        key[unique_id] = (class_type, inputs)
+    return json.dumps((key, sorted(item[4])), sort_keys=True)
+
+node_versions = {}
+
+def get_node_version(class_def):
+    """
+    Version of a node class for the persistent cache: its CACHE_VERSION attribute if it has one and
+    the modification time of the file it is defined in, so stored outputs are not reused after the
+    node code changes.
+    """
+    version = node_versions.get(class_def, None)
+    if version is None:
+        try:
+            mtime = os.stat(sys.modules[class_def.__module__].__file__).st_mtime_ns
+        except (KeyError, AttributeError, TypeError, OSError):
+            mtime = None
+        version = (getattr(class_def, "CACHE_VERSION", None), mtime)
+        node_versions[class_def] = version
+    return version
+
+def get_node_signature(prompt, current_item, signatures, outputs, cache):
+    # the signatures of the linked inputs have to be computed first, see get_topological_order
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
+    class_type = prompt[unique_id]['class_type']
+    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    for x in inputs:
+    valid_inputs = get_input_types(class_def)
+    combo_inputs = set()
+    if cache.persistent is not None:
+        for section in ("required", "optional"):
+            for x, info in valid_inputs.get(section, {}).items():
+                if isinstance(info[0], list):
+                    combo_inputs.add(x)
+
+    cacheable = True
+    signature_inputs = []
+    for x in sorted(inputs):
         input_data = inputs[x]
         if isinstance(input_data, list):
             input_unique_id = input_data[0]
             output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id)
+            input_signature = signatures.get(input_unique_id, None)
+            if input_signature is None:
+                cacheable = False
+            signature_inputs.append((x, "link", input_signature, output_index))
+        elif x in combo_inputs and isinstance(input_data, str):
+            #persisted outputs have to be invalidated when the model file they were computed from gets replaced
+            signature_inputs.append((x, input_data, folder_paths.get_model_file_fingerprint(input_data)))
+        else:
+            signature_inputs.append((x, input_data))
 
-    return will_execute + [unique_id]
+    lazy_output_inputs = get_lazy_output_inputs(prompt, unique_id, class_def)
+    if len(lazy_output_inputs) > 0:
+        signature_inputs.append(("lazy_outputs", sorted(lazy_output_inputs)))
 
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+    if cache.persistent is not None:
+        signature_inputs.append(("node_version", get_node_version(class_def)))
 
-    is_changed_old = ''
-    is_changed = ''
-    to_delete = False
-    if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    #is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
+    is_changed = None
+    if cacheable and hasattr(class_def, 'IS_CHANGED'):
+        input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
+        if input_data_all is None:
+            cacheable = False
         else:
-            is_changed = prompt[unique_id]['is_changed']
-
-    if unique_id not in outputs:
-        return True
-
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
+            try:
+                is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+                cacheable = execution_cache.is_changed_is_stable(is_changed)
+            except:
+                cacheable = False
+
+    node_id_dependent = False
+    if "hidden" in valid_inputs and "UNIQUE_ID" in valid_inputs["hidden"].values():
+        node_id_dependent = True
+
+    signature = None
+    if cacheable:
+        signature = execution_cache.signature_hash((class_type, signature_inputs, is_changed, unique_id if node_id_dependent else None))
+        entry = cache.get(signature)
+        if entry is not None:
+            outputs[unique_id] = entry.outputs
+
+    signatures[unique_id] = signature
+    return signature
+
+def merge_duplicate_nodes(prompt, order, signatures):
+    """
+    Nodes with the same signature as an earlier node in order have the same class, inputs and
+    upstream nodes so they would compute the same outputs. Returns a prompt where the links to
+    those duplicates point to the earlier node instead, and a dict of the merged node ids to the
+    node they were merged into. Output nodes are never merged.
+    """
+    first = {}
+    merged = {}
+    for unique_id in order:
+        signature = signatures.get(unique_id, None)
+        if signature is None:
+            continue
+        class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+        if getattr(class_def, "OUTPUT_NODE", False):
+            continue
+        if signature in first:
+            merged[unique_id] = first[signature]
         else:
-            to_delete = True
+            first[signature] = unique_id
 
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+    if len(merged) == 0:
+        return prompt, merged
+
+    new_prompt = {}
+    for unique_id, node in prompt.items():
+        inputs = node['inputs']
+        if any(isinstance(v, list) and v[0] in merged for v in inputs.values()):
+            node = dict(node)
+            node['inputs'] = {k: [merged[v[0]], v[1]] if isinstance(v, list) and v[0] in merged else v for k, v in inputs.items()}
+        new_prompt[unique_id] = node
+    return new_prompt, merged
 
 class PromptExecutor:
     def __init__(self, server):
         self.outputs = {}
         self.object_storage = {}
         self.outputs_ui = {}
-        self.old_prompt = {}
+        self.profile = {}
+        persistent = None
+        if args.persistent_cache_directory is not None:
+            persistent = execution_cache.PersistentCache(args.persistent_cache_directory, int(args.persistent_cache_size * 1024 * 1024 * 1024))
+        self.cache = execution_cache.NodeOutputCache(ram_budget=int(args.cache_ram_budget * 1024 * 1024 * 1024),
+                                                     spill_directory=args.cache_spill_directory,
+                                                     disk_budget=int(args.cache_spill_budget * 1024 * 1024 * 1024),
+                                                     persistent=persistent)
+        #cache entries of seed batch results by the id of the prompt they are for, see prepare_seed_batch
+        self.pinned = {}
         self.server = server
+        self.thread_pool = None
+        if args.parallel_cpu_nodes > 0:
+            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_cpu_nodes, thread_name_prefix="node_worker")
 
     def handle_execution_error(self, prompt_id, prompt, current_outputs, executed, error, ex):
         node_id = error["node_id"]
@@ -301,18 +567,6 @@ class PromptExecutor:
                 }
                 self.server.send_sync("execution_error", mes, self.server.client_id)
 
-        # Next, remove the subsequent outputs since they will not be executed
-        to_delete = []
-        for o in self.outputs:
-            if (o not in current_outputs) and (o not in executed):
-                to_delete += [o]
-                if o in self.old_prompt:
-                    d = self.old_prompt.pop(o)
-                    del d
-        for o in to_delete:
-            d = self.outputs.pop(o)
-            del d
-
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
 
@@ -324,15 +578,11 @@ class PromptExecutor:
         if self.server.client_id is not None:
             self.server.send_sync("execution_start", { "prompt_id": prompt_id}, self.server.client_id)
 
+        refresh_input_types()
         with torch.inference_mode():
-            #delete cached outputs if nodes don't exist for them
-            to_delete = []
-            for o in self.outputs:
-                if o not in prompt:
-                    to_delete += [o]
-            for o in to_delete:
-                d = self.outputs.pop(o)
-                del d
+            self.outputs = {}
+            self.outputs_ui = {}
+            self.profile = {}
             to_delete = []
             for o in self.object_storage:
                 if o[0] not in prompt:
@@ -345,41 +595,195 @@ class PromptExecutor:
                 d = self.object_storage.pop(o)
                 del d
 
-            for x in prompt:
-                recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
+            #reuse the outputs of any node whose structural signature is already cached
+            signatures = {}
+            order = get_topological_order(prompt, execute_outputs)
+            for x in order:
+                get_node_signature(prompt, x, signatures, self.outputs, self.cache)
+
+            #identical nodes in the prompt only get executed once, the merging is done on a copy of the prompt
+            original_prompt = prompt
+            prompt, merged = merge_duplicate_nodes(prompt, order, signatures)
+            for x in merged:
+                self.outputs.pop(x, None)
+                self.profile[x] = {"class_type": prompt[x]['class_type'], "merged_into": merged[x]}
 
             current_outputs = set(self.outputs.keys())
-            for x in list(self.outputs_ui.keys()):
-                if x not in current_outputs:
-                    d = self.outputs_ui.pop(x)
-                    del d
+            for x in current_outputs:
+                self.profile[x] = {"class_type": prompt[x]['class_type'], "cached": True}
+                ui = self.cache.get(signatures[x]).ui
+                if ui is not None and len(ui) > 0:
+                    self.outputs_ui[x] = ui
 
             if self.server.client_id is not None:
                 self.server.send_sync("execution_cached", { "nodes": list(current_outputs) , "prompt_id": prompt_id}, self.server.client_id)
+                for x in self.outputs_ui:
+                    self.server.send_sync("executed", { "node": x, "output": self.outputs_ui[x], "prompt_id": prompt_id }, self.server.client_id)
             executed = set()
-            output_node_id = None
-            to_execute = []
-
-            for node_id in list(execute_outputs):
-                to_execute += [(0, node_id)]
-
-            while len(to_execute) > 0:
-                #always execute the output that depends on the least amount of unexecuted nodes first
-                to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1])), a[-1]), to_execute)))
-                output_node_id = to_execute.pop(0)[-1]
-
-                # This call shouldn't raise anything if there's an error deep in
-                # the actual SD code, instead it will report the node where the
-                # error was raised
-                success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
-                if success is not True:
-                    self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
+            is_parallel = None
+            if self.thread_pool is not None:
+                is_parallel = lambda a: is_thread_safe(prompt, a)
+            schedule = ExecutionSchedule(prompt, self.outputs, execute_outputs, is_parallel=is_parallel)
+            running = {}
+            failure = None
+
+            def finish_parallel(future):
+                # the results of the thread pool are recorded and reported on this thread
+                unique_id, input_data_all = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    return node_error(unique_id, ex, input_data_all, self.outputs)
+                if self.server.client_id is not None:
+                    self.server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, self.server.client_id)
+                finish_node(self.server, self.outputs, unique_id, executed, prompt_id, self.outputs_ui, self.profile, result)
+                return (True, None, None)
+
+            while failure is None:
+                # thread safe nodes run on the thread pool while the other nodes run one at a time on this thread
+                while schedule.has_parallel():
+                    unique_id = schedule.pop_parallel()
+                    input_data_all = None
+                    try:
+                        input_data_all, obj = prepare_node(prompt, self.outputs, unique_id, extra_data, self.object_storage, original_prompt)
+                    except Exception as ex:
+                        success, error, ex = node_error(unique_id, ex, input_data_all, self.outputs)
+                        failure = (error, ex)
+                        break
+                    future = self.thread_pool.submit(run_node_inference_mode, obj, input_data_all, prompt[unique_id]['class_type'])
+                    running[future] = (unique_id, input_data_all)
+                if failure is not None:
                     break
 
+                if not schedule.is_empty():
+                    unique_id = schedule.pop()
+
+                    # This call shouldn't raise anything if there's an error deep in
+                    # the actual SD code, instead it will report the node where the
+                    # error was raised
+                    success, error, ex = execute_node(self.server, prompt, self.outputs, unique_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, self.profile, original_prompt)
+                    if success is not True:
+                        failure = (error, ex)
+                        break
+                    schedule.complete(unique_id)
+                    done = [f for f in running if f.done()]
+                elif len(running) > 0:
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    break
+
+                for future in done:
+                    unique_id = running[future][0]
+                    success, error, ex = finish_parallel(future)
+                    if success is not True:
+                        failure = (error, ex)
+                    else:
+                        schedule.complete(unique_id)
+
+            # let the nodes that are still running finish before reporting anything
+            for future in list(concurrent.futures.as_completed(running)):
+                success, error, ex = finish_parallel(future)
+                if success is not True and failure is None:
+                    failure = (error, ex)
+
+            if failure is not None:
+                self.handle_execution_error(prompt_id, prompt, current_outputs, executed, failure[0], failure[1])
+            elif schedule.remaining > 0:
+                print("Warning: {} nodes could not be executed because of a cycle in the prompt".format(schedule.remaining))
+
             for x in executed:
-                self.old_prompt[x] = copy.deepcopy(prompt[x])
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']]
+                persist = not getattr(class_def, "OUTPUT_NODE", False)
+                self.cache.set(signatures[x], self.outputs[x], self.outputs_ui.get(x, None), persist=persist)
+            self.release_pinned([prompt_id])
+            self.cache.clean(keep=set(signatures.values()).union(*self.pinned.values()))
             self.server.last_node_id = None
 
+    def prepare_seed_batch(self, items):
+        """
+        Runs the seed batchable nodes (samplers) of queue items that only differ by their seeds
+        in a single batch, see get_seed_batch_key. The result for each seed is put in the cache
+        so the sampler of each prompt gets it from there when the prompt is executed.
+        """
+        prompts = [x[2] for x in items]
+        prompt = prompts[0]
+        extra_data = items[0][3]
+        execute_outputs = items[0][4]
+        self.server.client_id = None
+
+        refresh_input_types()
+        with torch.inference_mode():
+            self.outputs = {}
+            self.outputs_ui = {}
+            order = get_topological_order(prompt, execute_outputs)
+            signatures = []
+            for p in prompts:
+                s = {}
+                outputs = self.outputs if p is prompt else {}
+                for x in order:
+                    get_node_signature(p, x, s, outputs, self.cache)
+                signatures.append(s)
+
+            for unique_id in order:
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+                seed_input = getattr(class_def, "SEED_BATCH_INPUT", None)
+                inputs = prompt[unique_id]['inputs']
+                if seed_input is None or seed_input not in inputs or isinstance(inputs[seed_input], list):
+                    continue
+                if getattr(class_def, "INPUT_IS_LIST", False):
+                    continue
+
+                node_signatures = [s[unique_id] for s in signatures]
+                if None in node_signatures or all(x in self.cache for x in node_signatures):
+                    continue
+
+                # the nodes it depends on have to be the same in every prompt
+                linked = get_linked_inputs(prompt, unique_id)
+                if any(s.get(x, None) is None or s[x] != signatures[0][x] for s in signatures for x in linked):
+                    continue
+
+                executed = set()
+                schedule = ExecutionSchedule(prompt, self.outputs, linked)
+                while not schedule.is_empty():
+                    x = schedule.pop()
+                    success, error, ex = execute_node(self.server, prompt, self.outputs, x, extra_data, executed, items[0][1], self.outputs_ui, self.object_storage)
+                    if success is not True:
+                        # the error gets reported when the prompt itself is executed
+                        return
+                    schedule.complete(x)
+                for x in executed:
+                    self.cache.set(signatures[0][x], self.outputs[x], self.outputs_ui.get(x, None))
+
+                input_data_all = get_input_data(inputs, class_def, unique_id, self.outputs, prompt, extra_data)
+                if input_data_all is None or any(len(v) != 1 for v in input_data_all.values()):
+                    continue
+                input_data = {x: input_data_all[x][0] for x in input_data_all if x != seed_input}
+                seeds = [p[unique_id]['inputs'][seed_input] for p in prompts]
+
+                obj = self.object_storage.get((unique_id, prompt[unique_id]['class_type']), None)
+                if obj is None:
+                    obj = class_def()
+                    self.object_storage[(unique_id, prompt[unique_id]['class_type'])] = obj
+
+                try:
+                    nodes.before_node_execution()
+                    results = getattr(obj, class_def.SEED_BATCH_FUNCTION)(seeds=seeds, **input_data)
+                except Exception as ex:
+                    print(traceback.format_exc())
+                    print("Seed batch failed, the prompts will be executed one by one:", ex)
+                    return
+
+                if results is None:
+                    continue
+                for item, x, r in zip(items, node_signatures, results):
+                    self.cache.set(x, [[o] for o in r])
+                    self.pinned.setdefault(item[1], set()).add(x)
+
+    def release_pinned(self, prompt_ids):
+        # lets the cache evict the seed batch results of these prompts
+        for x in prompt_ids:
+            self.pinned.pop(x, None)
+
 
 
 def validate_inputs(prompt, item, validated):
@@ -391,11 +795,13 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    class_inputs = obj_class.INPUT_TYPES()
+    class_inputs = get_input_types(obj_class)
     required_inputs = class_inputs['required']
 
     errors = []
     valid = True
+    validate_function_args = None
+    validate_function_ret = None
 
     for x in required_inputs:
         if x not in inputs:
@@ -526,10 +932,41 @@ def validate_inputs(prompt, item, validated):
                     errors.append(error)
                     continue
 
+            # classes with VALIDATE_INPUTS check their combo values themselves unless they set VALIDATE_COMBO_INPUTS
+            if isinstance(type_input, list) and (not hasattr(obj_class, "VALIDATE_INPUTS") or getattr(obj_class, "VALIDATE_COMBO_INPUTS", False) == True):
+                if val not in type_input:
+                    input_config = info
+                    list_info = ""
+
+                    # Don't send back gigantic lists like if they're lots of
+                    # scanned model filepaths
+                    if len(type_input) > 20:
+                        list_info = f"(list of length {len(type_input)})"
+                        input_config = None
+                    else:
+                        list_info = str(type_input)
+
+                    error = {
+                        "type": "value_not_in_list",
+                        "message": "Value not in list",
+                        "details": f"{x}: '{val}' not in {list_info}",
+                        "extra_info": {
+                            "input_name": x,
+                            "input_config": input_config,
+                            "received_value": val,
+                        }
+                    }
+                    errors.append(error)
+                    continue
+
             if hasattr(obj_class, "VALIDATE_INPUTS"):
                 input_data_all = get_input_data(inputs, obj_class, unique_id)
-                #ret = obj_class.VALIDATE_INPUTS(**input_data_all)
-                ret = map_node_over_list(obj_class, input_data_all, "VALIDATE_INPUTS")
+                # the arguments are usually the same for every input of the node so the last result gets reused
+                if validate_function_args is None or input_data_all != validate_function_args:
+                    #ret = obj_class.VALIDATE_INPUTS(**input_data_all)
+                    validate_function_ret = map_node_over_list(obj_class, input_data_all, "VALIDATE_INPUTS")
+                    validate_function_args = input_data_all
+                ret = validate_function_ret
                 for i, r in enumerate(ret):
                     if r is not True:
                         details = f"{x}"
@@ -548,32 +985,6 @@ def validate_inputs(prompt, item, validated):
                         }
                         errors.append(error)
                         continue
-            else:
-                if isinstance(type_input, list):
-                    if val not in type_input:
-                        input_config = info
-                        list_info = ""
-
-                        # Don't send back gigantic lists like if they're lots of
-                        # scanned model filepaths
-                        if len(type_input) > 20:
-                            list_info = f"(list of length {len(type_input)})"
-                            input_config = None
-                        else:
-                            list_info = str(type_input)
-
-                        error = {
-                            "type": "value_not_in_list",
-                            "message": "Value not in list",
-                            "details": f"{x}: '{val}' not in {list_info}",
-                            "extra_info": {
-                                "input_name": x,
-                                "input_config": input_config,
-                                "received_value": val,
-                            }
-                        }
-                        errors.append(error)
-                        continue
 
     if len(errors) > 0 or valid is not True:
         ret = (False, errors, unique_id)
@@ -589,7 +1000,29 @@ def full_type_name(klass):
         return klass.__qualname__
     return module + '.' + klass.__qualname__
 
+# validate_prompt runs on the event loop and on the prompt worker thread at the same time
+validation_cache = collections.OrderedDict()
+validation_cache_mutex = threading.Lock()
+MAX_VALIDATION_CACHE_SIZE = 10000
+
+def get_validation_keys(prompt, output_ids):
+    # structural hash of each node and everything upstream of it, like the execution signatures but without IS_CHANGED
+    folder_state = input_types_folder_state
+    keys = {}
+    for unique_id in get_topological_order(prompt, output_ids):
+        inputs = prompt[unique_id]['inputs']
+        key_inputs = []
+        for x in sorted(inputs):
+            input_data = inputs[x]
+            if isinstance(input_data, list):
+                key_inputs.append((x, "link", keys.get(input_data[0], None), input_data[1:]))
+            else:
+                key_inputs.append((x, input_data))
+        keys[unique_id] = execution_cache.signature_hash((prompt[unique_id]['class_type'], key_inputs, folder_state))
+    return keys
+
 def validate_prompt(prompt):
+    refresh_input_types()
     outputs = set()
     for x in prompt:
         class_ = nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']]
@@ -609,6 +1042,25 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+
+    # nodes that were valid in a previous prompt and have all their inputs valid in this one don't get validated again
+    try:
+        validation_keys = get_validation_keys(prompt, outputs)
+        # VALIDATE_INPUTS can depend on more than the inputs, like the files LoadImage checks, so those nodes always get validated
+        validation_keys = {x: validation_keys[x] for x in validation_keys if not hasattr(nodes.NODE_CLASS_MAPPINGS[prompt[x]['class_type']], "VALIDATE_INPUTS")}
+    except:
+        validation_keys = {}
+    for unique_id, key in validation_keys.items():
+        if not all(x in validated for x in get_linked_inputs(prompt, unique_id)):
+            continue
+        with validation_cache_mutex:
+            cached = validation_cache.get(key, None)
+            if cached is not None:
+                validation_cache.move_to_end(key)
+        if cached is not None:
+            prompt[unique_id]['inputs'].update(cached)
+            validated[unique_id] = (True, [], unique_id)
+
     for o in outputs:
         valid = False
         reasons = []
@@ -660,6 +1112,15 @@ def validate_prompt(prompt):
                     node_errors[node_id]["dependent_outputs"].append(o)
             print("Output will be ignored")
 
+    with validation_cache_mutex:
+        for unique_id, result in validated.items():
+            if result[0] is True and unique_id in validation_keys:
+                inputs = prompt[unique_id]['inputs']
+                validation_cache[validation_keys[unique_id]] = {x: inputs[x] for x in inputs if not isinstance(inputs[x], list)}
+                validation_cache.move_to_end(validation_keys[unique_id])
+        while len(validation_cache) > MAX_VALIDATION_CACHE_SIZE:
+            validation_cache.popitem(last=False)
+
     if len(good_outputs) == 0:
         errors_list = []
         for o, errors in errors:
@@ -679,6 +1140,131 @@ def validate_prompt(prompt):
     return (True, None, list(good_outputs), node_errors)
 
 
+def get_sweep_overrides(sweep={}, variants=[], max_items=None):
+    """
+    Lists the input overrides ({node_id: {input_name: value}}) of each prompt of a batch: every
+    entry of variants combined with every combination of the values listed in sweep
+    ({node_id: {input_name: [values]}}). Raises ValueError if they are malformed or if there
+    would be more than max_items prompts.
+    """
+    if not isinstance(sweep, dict) or not isinstance(variants, list):
+        raise ValueError("sweep has to be an object and variants a list")
+    if len(variants) == 0:
+        variants = [{}]
+    for variant in variants:
+        if not isinstance(variant, dict) or not all(isinstance(v, dict) for v in variant.values()):
+            raise ValueError("each variant has to be an object of node ids to input values")
+    axes = []
+    for node_id in sweep:
+        if not isinstance(sweep[node_id], dict):
+            raise ValueError("the sweep of node {} has to be an object of input names to lists of values".format(node_id))
+        for input_name, values in sweep[node_id].items():
+            if not isinstance(values, list):
+                raise ValueError("the sweep values of {}.{} have to be a list".format(node_id, input_name))
+            axes.append((node_id, input_name, values))
+
+    count = len(variants) * math.prod(len(a[2]) for a in axes)
+    if max_items is not None and count > max_items:
+        raise ValueError("batch has {} prompts, the maximum is {}".format(count, max_items))
+    out = []
+    for variant in variants:
+        for combination in itertools.product(*[a[2] for a in axes]):
+            overrides = {node_id: dict(variant[node_id]) for node_id in variant}
+            for (node_id, input_name, _), value in zip(axes, combination):
+                overrides.setdefault(node_id, {})[input_name] = value
+            out.append(overrides)
+    return out
+
+def validate_prompt_variant(prompt, overrides):
+    """
+    Applies input overrides to a copy of a prompt that passed validate_prompt and only validates
+    the nodes that were changed. Returns the same tuple as validate_prompt but with the new
+    prompt in place of the outputs.
+    """
+    prompt = copy.deepcopy(prompt)
+    for node_id in overrides:
+        if node_id not in prompt:
+            error = {
+                "type": "invalid_override",
+                "message": "Override for a node that isn't in the prompt",
+                "details": f"{node_id}",
+                "extra_info": {}
+            }
+            return (False, error, None, {})
+        class_inputs = get_input_types(nodes.NODE_CLASS_MAPPINGS[prompt[node_id]['class_type']])
+        for input_name, value in overrides[node_id].items():
+            if input_name not in class_inputs.get("required", {}) and input_name not in class_inputs.get("optional", {}):
+                error = {
+                    "type": "invalid_override",
+                    "message": "Override for an input the node doesn't have",
+                    "details": f"{node_id}.{input_name}",
+                    "extra_info": {}
+                }
+                return (False, error, None, {})
+            if isinstance(value, list):
+                error = {
+                    "type": "invalid_override",
+                    "message": "Overrides can only set input values, not links",
+                    "details": f"{node_id}.{input_name}",
+                    "extra_info": {}
+                }
+                return (False, error, None, {})
+            prompt[node_id]['inputs'][input_name] = value
+
+    validated = {x: (True, [], x) for x in prompt if x not in overrides}
+    node_errors = {}
+    for node_id in overrides:
+        try:
+            m = validate_inputs(prompt, node_id, validated)
+        except Exception as ex:
+            m = (False, [{"type": "exception_during_validation", "message": "Exception when validating node", "details": str(ex), "extra_info": {}}], node_id)
+        if m[0] is not True:
+            node_errors[node_id] = {"errors": m[1], "dependent_outputs": [], "class_type": prompt[node_id]['class_type']}
+
+    if len(node_errors) > 0:
+        errors_list = "\n".join(f"{e['message']}: {e['details']}" for x in node_errors.values() for e in x["errors"])
+        error = {
+            "type": "prompt_outputs_failed_validation",
+            "message": "Prompt outputs failed validation",
+            "details": errors_list,
+            "extra_info": {}
+        }
+        return (False, error, None, node_errors)
+    return (True, None, prompt, {})
+
+def validate_prompt_batch(prompt, sweep={}, variants=[], max_items=None):
+    """
+    Validates the prompt of a batch and each of its variants, see get_sweep_overrides. Returns
+    (True, the validate_prompt result, the list of prompts) or (False, error, node_errors, the
+    overrides of the variant that failed).
+    """
+    valid = validate_prompt(prompt)
+    if not valid[0]:
+        return (False, valid[1], valid[3], None)
+
+    try:
+        overrides = get_sweep_overrides(sweep, variants, max_items)
+    except ValueError as e:
+        error = {
+            "type": "invalid_sweep",
+            "message": "Invalid sweep",
+            "details": str(e),
+            "extra_info": {}
+        }
+        return (False, error, [], None)
+
+    prompts = []
+    for x in overrides:
+        v = validate_prompt_variant(prompt, x)
+        if not v[0]:
+            return (False, v[1], v[3], x)
+        prompts.append(v[2])
+    return (True, valid, prompts)
+
+
+MAX_JOURNAL_RECORDS = 10000
+MAX_BATCHES = 1000
+
 class PromptQueue:
     def __init__(self, server):
         self.server = server
@@ -687,12 +1273,35 @@ class PromptQueue:
         self.task_counter = 0
         self.queue = []
         self.currently_running = {}
-        self.history = {}
+        self.history = history_store.HistoryStore(args.history_database if args.history_database is not None else ":memory:",
+                                                  max_items=args.history_max_items,
+                                                  max_age=args.history_max_age * 60 * 60)
+        self.seed_batch_keys = {}
+        self.batches = collections.OrderedDict()
+        client_weights = {}
+        for x in args.client_weight:
+            client_id, weight = x.rsplit("=", 1)
+            client_weights[client_id] = float(weight)
+        self.scheduler = prompt_scheduler.PromptScheduler(args.scheduler, client_weights, max_skips=args.scheduler_max_skips)
+        self.journal = None
+        if args.queue_journal is not None:
+            self.journal = queue_journal.QueueJournal(args.queue_journal)
+            items = self.journal.replay()
+            for item in items:
+                self.scheduler.add(item)
+                heapq.heappush(self.queue, item)
+                server.number = max(server.number, int(abs(item[0])) + 1)
+            if len(items) > 0:
+                print("Restored {} prompts from the queue journal.".format(len(items)))
         server.prompt_queue = self
 
     def put(self, item):
         with self.mutex:
+            if self.journal is not None:
+                self.journal.put(item)
+            self.scheduler.add(item)
             heapq.heappush(self.queue, item)
+            self.prefetch_next()
             self.server.queue_updated()
             self.not_empty.notify()
 
@@ -700,19 +1309,79 @@ class PromptQueue:
         with self.not_empty:
             while len(self.queue) == 0:
                 self.not_empty.wait()
-            item = heapq.heappop(self.queue)
+            item = self.scheduler.select(self.queue)
+            if item is self.queue[0]:
+                heapq.heappop(self.queue)
+            else:
+                self.queue = [x for x in self.queue if x is not item]
+                heapq.heapify(self.queue)
+            self.scheduler.started(item)
+            if self.journal is not None:
+                self.journal.get(item[1])
             i = self.task_counter
             self.currently_running[i] = copy.deepcopy(item)
             self.task_counter += 1
+            self.prefetch_next()
             self.server.queue_updated()
             return (item, i)
 
-    def task_done(self, item_id, outputs):
+    def prefetch_next(self):
+        # the model files of the prompt that runs after the current one get read in the background
+        if model_prefetch.enabled() and len(self.queue) > 0:
+            model_prefetch.prefetch_prompt(self.scheduler.peek(self.queue)[2])
+
+    def get_seed_batch(self, item, max_items):
+        # removes up to max_items pending items that only differ from item by their seeds and marks them as running
         with self.mutex:
-            prompt = self.currently_running.pop(item_id)
-            self.history[prompt[1]] = { "prompt": prompt, "outputs": {} }
-            for o in outputs:
-                self.history[prompt[1]]["outputs"][o] = outputs[o]
+            key = get_seed_batch_key(item)
+            keys = {}
+            batch = []
+            for x in sorted(self.queue, key=lambda a: (a[0], a[1])):
+                if len(batch) >= max_items:
+                    break
+                if x[1] not in self.seed_batch_keys:
+                    self.seed_batch_keys[x[1]] = get_seed_batch_key(x)
+                keys[x[1]] = self.seed_batch_keys[x[1]]
+                if keys[x[1]] == key:
+                    batch.append(x)
+            self.seed_batch_keys = keys
+
+            if len(batch) == 0:
+                return []
+
+            batch_ids = set(x[1] for x in batch)
+            self.queue = [x for x in self.queue if x[1] not in batch_ids]
+            heapq.heapify(self.queue)
+            out = []
+            for x in batch:
+                self.scheduler.started(x)
+                if self.journal is not None:
+                    self.journal.get(x[1])
+                i = self.task_counter
+                self.currently_running[i] = copy.deepcopy(x)
+                self.task_counter += 1
+                out.append((x, i))
+            self.server.queue_updated()
+            return out
+
+    def task_done(self, item_id, outputs, profile=None):
+        with self.mutex:
+            prompt = self.currently_running[item_id]
+        entry = { "prompt": prompt, "outputs": {} }
+        for o in outputs:
+            entry["outputs"][o] = outputs[o]
+        if profile is not None:
+            entry["profile"] = profile
+        #added to the history before the prompt leaves currently_running so it is never missing from both
+        self.history.add(prompt[1], history_store.encode_entry(entry))
+        with self.mutex:
+            self.currently_running.pop(item_id)
+            self.scheduler.finished(prompt[1])
+            if self.journal is not None:
+                self.journal.done(prompt[1])
+                if self.journal.records > MAX_JOURNAL_RECORDS:
+                    running = [x for x in self.currently_running.values()]
+                    self.journal.compact(running + self.queue, attempts={x[1]: 1 for x in running})
             self.server.queue_updated()
 
     def get_current_queue(self):
@@ -722,12 +1391,90 @@ class PromptQueue:
                 out += [x]
             return (out, copy.deepcopy(self.queue))
 
+    def get_admission_error(self, items):
+        """
+        Checks if the items (all from the same client) fit in the queue limits set with the
+        command line arguments. Returns None if they can be queued, otherwise the error and the
+        number of seconds after which the client should retry. Prompts are never rejected for
+        their cost alone when nothing is queued before them.
+        """
+        client = items[0][3].get("client_id", None)
+        with self.mutex:
+            cost = 0.0
+            for item in items:
+                item_cost, models = prompt_scheduler.estimate_cost(item[2])
+                cost += item_cost + prompt_scheduler.load_cost(models - self.scheduler.loaded_models)
+            pending = self.scheduler.pending_by_client()
+            seconds_per_cost = self.scheduler.seconds_per_cost
+
+        new = len(items)
+        count = sum(x[0] for x in pending.values())
+        total_cost = sum(x[1] for x in pending.values())
+        client_count, client_cost = pending.get(client, (0, 0.0))
+        average_cost = total_cost / count if count > 0 else cost / new
+
+        error = None
+        if args.max_queue_size > 0 and count + new > args.max_queue_size:
+            error = ("Too many prompts in the queue", (count + new - args.max_queue_size) * average_cost)
+        elif args.max_queue_cost > 0 and count > 0 and total_cost + cost > args.max_queue_cost:
+            error = ("The estimated cost of the queued prompts is over the limit", total_cost + cost - args.max_queue_cost)
+        elif args.max_client_queue_size > 0 and client_count + new > args.max_client_queue_size:
+            error = ("Too many prompts in the queue for this client", (client_count + new - args.max_client_queue_size) * average_cost)
+        elif args.max_client_queue_cost > 0 and client_count > 0 and client_cost + cost > args.max_client_queue_cost:
+            error = ("The estimated cost of the queued prompts of this client is over the limit", client_cost + cost - args.max_client_queue_cost)
+
+        if error is None:
+            return None
+        retry_after = max(1, math.ceil(error[1] * seconds_per_cost))
+        return ({
+            "type": "queue_full",
+            "message": error[0],
+            "details": "Retry in {} seconds".format(retry_after),
+            "extra_info": {"queue_size": count, "queue_cost": total_cost, "prompt_cost": cost}
+        }, retry_after)
+
+    def add_batch(self, batch_id, prompt_ids):
+        with self.mutex:
+            self.batches[batch_id] = prompt_ids
+            while len(self.batches) > MAX_BATCHES:
+                self.batches.popitem(last=False)
+
+    def get_batch_status(self, batch_id):
+        with self.mutex:
+            prompt_ids = self.batches.get(batch_id, None)
+            if prompt_ids is None:
+                return None
+            pending = set(x[1] for x in self.queue)
+            running = set(x[1] for x in self.currently_running.values())
+        completed = self.history.get_existing(prompt_ids)
+        status = {"batch_id": batch_id, "total": len(prompt_ids), "pending": 0, "running": 0, "completed": 0, "deleted": 0, "prompts": {}}
+        for x in prompt_ids:
+            if x in completed:
+                s = "completed"
+            elif x in running:
+                s = "running"
+            elif x in pending:
+                s = "pending"
+            else:
+                s = "deleted"
+            status[s] += 1
+            status["prompts"][x] = s
+        return status
+
+    def get_eta(self, prompt_id):
+        with self.mutex:
+            return self.scheduler.eta(prompt_id, self.queue)
+
     def get_tasks_remaining(self):
         with self.mutex:
             return len(self.queue) + len(self.currently_running)
 
     def wipe_queue(self):
         with self.mutex:
+            if self.journal is not None:
+                self.journal.wipe([x[1] for x in self.queue])
+            for x in self.queue:
+                self.scheduler.remove(x)
             self.queue = []
             self.server.queue_updated()
 
@@ -735,6 +1482,9 @@ class PromptQueue:
         with self.mutex:
             for x in range(len(self.queue)):
                 if function(self.queue[x]):
+                    if self.journal is not None:
+                        self.journal.delete(self.queue[x][1])
+                    self.scheduler.remove(self.queue[x])
                     if len(self.queue) == 1:
                         self.wipe_queue()
                     else:
@@ -744,19 +1494,11 @@ class PromptQueue:
                     return True
         return False
 
-    def get_history(self, prompt_id=None):
-        with self.mutex:
-            if prompt_id is None:
-                return copy.deepcopy(self.history)
-            elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
-            else:
-                return {}
+    def get_history(self, prompt_id=None, offset=0, limit=None, since=None):
+        return self.history.get(prompt_id=prompt_id, offset=offset, limit=limit, since=since)
 
     def wipe_history(self):
-        with self.mutex:
-            self.history = {}
+        self.history.clear()
 
     def delete_history_item(self, id_to_delete):
-        with self.mutex:
-            self.history.pop(id_to_delete, None)
+        self.history.delete(id_to_delete)
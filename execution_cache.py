@@ -0,0 +1,385 @@
+import atexit
+import collections
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+
+import psutil
+
+import torch
+import safetensors.torch
+
+
+def estimate_size(obj, seen=None):
+    #rough estimate of the memory held by a node output, counts tensors and module weights
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, torch.Tensor):
+        return obj.nelement() * obj.element_size()
+    if isinstance(obj, torch.nn.Module):
+        size = 0
+        for t in list(obj.parameters()) + list(obj.buffers()):
+            size += estimate_size(t, seen)
+        return size
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return 0
+    if isinstance(obj, dict):
+        return sum(estimate_size(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sum(estimate_size(v, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return estimate_size(vars(obj), seen)
+    return 0
+
+def is_changed_is_stable(is_changed):
+    #IS_CHANGED returning NaN is the convention for "always re-execute"
+    for x in is_changed:
+        if isinstance(x, float) and math.isnan(x):
+            return False
+    return True
+
+def signature_hash(signature):
+    return hashlib.sha256(repr(signature).encode("utf-8")).hexdigest()
+
+
+class SpilledTensor:
+    def __init__(self, name, device):
+        self.name = name
+        self.device = device
+
+def split_tensors(obj, tensors):
+    #replaces the tensors in obj with SpilledTensor placeholders, returns None if obj contains anything else than
+    #tensors, plain values and containers of them (models, controlnets, etc...)
+    if isinstance(obj, torch.Tensor):
+        #cloned because safetensors refuses to save tensors sharing storage
+        name = str(len(tensors))
+        tensors[name] = obj.detach().to("cpu").clone(memory_format=torch.contiguous_format)
+        return SpilledTensor(name, obj.device)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return obj
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if not isinstance(k, str):
+                return None
+            out[k] = split_tensors(v, tensors)
+            if out[k] is None and v is not None:
+                return None
+        return out
+    if isinstance(obj, (list, tuple)):
+        out = []
+        for v in obj:
+            o = split_tensors(v, tensors)
+            if o is None and v is not None:
+                return None
+            out.append(o)
+        return type(obj)(out)
+    return None
+
+def join_tensors(obj, tensors):
+    if isinstance(obj, SpilledTensor):
+        return tensors[obj.name].to(obj.device)
+    if isinstance(obj, dict):
+        return {k: join_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(join_tensors(v, tensors) for v in obj)
+    return obj
+
+def skeleton_to_json(obj):
+    if isinstance(obj, SpilledTensor):
+        return {"tensor": obj.name, "device": str(obj.device)}
+    if isinstance(obj, dict):
+        return {"dict": {k: skeleton_to_json(v) for k, v in obj.items()}}
+    if isinstance(obj, list):
+        return {"list": [skeleton_to_json(v) for v in obj]}
+    if isinstance(obj, tuple):
+        return {"tuple": [skeleton_to_json(v) for v in obj]}
+    return {"value": obj}
+
+def skeleton_from_json(obj):
+    if "tensor" in obj:
+        return SpilledTensor(obj["tensor"], torch.device(obj["device"]))
+    if "dict" in obj:
+        return {k: skeleton_from_json(v) for k, v in obj["dict"].items()}
+    if "list" in obj:
+        return [skeleton_from_json(v) for v in obj["list"]]
+    if "tuple" in obj:
+        return tuple(skeleton_from_json(v) for v in obj["tuple"])
+    return obj["value"]
+
+class SpilledOutputs:
+    """
+    Node outputs whose tensors were written to a safetensors file. Behaves like the outputs list,
+    the file only gets read when one of the outputs is actually accessed.
+    """
+    def __init__(self, path, skeleton, length, temporary=True):
+        self.path = path
+        self.skeleton = skeleton
+        self.length = length
+        self.temporary = temporary
+        self.loaded = None
+        self.mutex = threading.Lock()
+
+    def load(self):
+        with self.mutex:
+            if self.loaded is None:
+                self.loaded = join_tensors(self.skeleton, safetensors.torch.load_file(self.path, device="cpu"))
+            return self.loaded
+
+    def release(self):
+        with self.mutex:
+            self.loaded = None
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return self.length
+
+class CacheEntry:
+    def __init__(self, outputs, ui, size):
+        self.outputs = outputs
+        self.ui = ui
+        self.size = size
+        self.disk_size = 0
+
+    def spilled(self):
+        return isinstance(self.outputs, SpilledOutputs)
+
+class PersistentCache:
+    """
+    Node outputs stored in a directory so they survive restarts, one safetensors file per
+    signature with the structure of the outputs in the metadata. The least recently used
+    files are deleted once the directory goes over size_budget bytes.
+    """
+    def __init__(self, directory, size_budget):
+        self.directory = directory
+        self.size_budget = size_budget
+        self.files = collections.OrderedDict()
+        self.total_size = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+        found = []
+        for f in os.scandir(self.directory):
+            if f.is_file() and f.name.endswith(".safetensors"):
+                st = f.stat()
+                found.append((st.st_mtime_ns, f.name[:-len(".safetensors")], st.st_size))
+        for mtime, key, size in sorted(found):
+            self.files[key] = size
+            self.total_size += size
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}.safetensors".format(key))
+
+    def load(self, key):
+        if key not in self.files:
+            return None
+        path = self.path(key)
+        try:
+            with safetensors.safe_open(path, framework="pt") as f:
+                metadata = f.metadata()
+            skeleton = skeleton_from_json(json.loads(metadata["outputs"]))
+            os.utime(path)
+        except Exception as e:
+            print("Failed to load persistent cache entry:", path, e)
+            self.remove(key)
+            return None
+        self.files.move_to_end(key)
+        return SpilledOutputs(path, skeleton, len(skeleton), temporary=False)
+
+    def store(self, key, outputs):
+        if key in self.files:
+            return
+        tensors = {}
+        skeleton = split_tensors(outputs, tensors)
+        if skeleton is None:
+            return
+        try:
+            metadata = {"outputs": json.dumps(skeleton_to_json(skeleton))}
+        except TypeError:
+            return
+
+        path = self.path(key)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            safetensors.torch.save_file(tensors, temp_path, metadata=metadata)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print("Failed to write persistent cache entry:", path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        size = os.path.getsize(path)
+        self.files[key] = size
+        self.total_size += size
+        for k in list(self.files.keys()):
+            if self.total_size <= self.size_budget:
+                break
+            self.remove(k)
+
+    def remove(self, key):
+        size = self.files.pop(key, None)
+        if size is None:
+            return
+        self.total_size -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+def remove_stale_spill_directories(directory):
+    # the spill subdirectories are named after the pid of their process, several processes can share the directory
+    for name in os.listdir(directory):
+        parts = name.split("_", 2)
+        if len(parts) != 3 or parts[0] != "spill" or not parts[1].isdigit():
+            continue
+        if not psutil.pid_exists(int(parts[1])):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+class NodeOutputCache:
+    """
+    Node outputs keyed by the structural hash of the node (class_type, literal inputs,
+    IS_CHANGED result and the hashes of the upstream nodes) so identical subgraphs hit
+    the cache no matter which prompt or node ids they come from.
+
+    Entries used by the last prompt are always kept, older ones are evicted in LRU
+    order once the total size goes over ram_budget bytes. If spill_directory is set
+    the tensors of those entries are written to a subdirectory of it for this process
+    instead and read back when a later prompt needs them, up to disk_budget bytes. The
+    subdirectory is deleted on exit and the ones left by processes that crashed are
+    deleted on startup.
+
+    With a PersistentCache the outputs stored with persist=True are also written there
+    and entries missing from memory are looked up there.
+    """
+    def __init__(self, ram_budget=0, spill_directory=None, disk_budget=0, persistent=None):
+        self.ram_budget = ram_budget
+        self.spill_directory = spill_directory
+        self.disk_budget = disk_budget
+        self.persistent = persistent
+        self.entries = collections.OrderedDict()
+        self.total_size = 0
+        self.disk_size = 0
+        if self.spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok=True)
+            remove_stale_spill_directories(spill_directory)
+            self.spill_directory = tempfile.mkdtemp(prefix="spill_{}_".format(os.getpid()), dir=spill_directory)
+            atexit.register(shutil.rmtree, self.spill_directory, ignore_errors=True)
+
+    def __contains__(self, key):
+        return key is not None and key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key is None:
+            return None
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.persistent is not None:
+            outputs = self.persistent.load(key)
+            if outputs is not None:
+                entry = CacheEntry(outputs, None, 0)
+                self.entries[key] = entry
+        if entry is not None and entry.spilled() and not entry.outputs.temporary:
+            #the persistent directory evicts files, also from other processes sharing it, so the (small) tensors
+            #are read now and a file that is gone is a cache miss instead of an error when the outputs get used
+            try:
+                entry.outputs.load()
+            except Exception as e:
+                print("Failed to load persistent cache entry:", entry.outputs.path, e)
+                self.pop(key)
+                self.persistent.remove(key)
+                return None
+        return entry
+
+    def set(self, key, outputs, ui=None, persist=False):
+        if key is None:
+            return
+        self.pop(key)
+        entry = CacheEntry(outputs, ui, estimate_size(outputs))
+        self.entries[key] = entry
+        self.total_size += entry.size
+        if persist and self.persistent is not None:
+            self.persistent.store(key, outputs)
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_size -= entry.size
+            self.disk_size -= entry.disk_size
+            if entry.spilled() and entry.outputs.temporary:
+                try:
+                    os.remove(entry.outputs.path)
+                except OSError:
+                    pass
+        return entry
+
+    def spill(self, key):
+        entry = self.entries[key]
+        if self.spill_directory is None or entry.size == 0:
+            return False
+
+        tensors = {}
+        skeleton = split_tensors(entry.outputs, tensors)
+        if skeleton is None:
+            return False
+
+        path = os.path.join(self.spill_directory, "{}.safetensors".format(key))
+        try:
+            safetensors.torch.save_file(tensors, path)
+        except Exception as e:
+            print("Failed to spill cached outputs to disk:", e)
+            return False
+
+        self.total_size -= entry.size
+        entry.outputs = SpilledOutputs(path, skeleton, len(entry.outputs))
+        entry.size = 0
+        entry.disk_size = os.path.getsize(path)
+        self.disk_size += entry.disk_size
+        return True
+
+    def clean(self, keep=()):
+        for key in list(self.entries.keys()):
+            if self.total_size <= self.ram_budget:
+                break
+            if key in keep or self.entries[key].spilled():
+                continue
+            if not self.spill(key):
+                self.pop(key)
+
+        for key in list(self.entries.keys()):
+            entry = self.entries[key]
+            if not entry.spilled():
+                continue
+            if key in keep:
+                entry.outputs.release()
+            elif not entry.outputs.temporary:
+                #loaded from the persistent directory again if it's needed
+                self.pop(key)
+            elif self.disk_size > self.disk_budget and entry.disk_size > 0:
+                self.pop(key)
+            else:
+                entry.outputs.release()
+
+    def clear(self):
+        for key in list(self.entries.keys()):
+            self.pop(key)
+        self.total_size = 0
+        self.disk_size = 0
@@ -1,5 +1,7 @@
 import os
 import time
+import hashlib
+import threading
 
 supported_ckpt_extensions = set(['.ckpt', '.pth', '.safetensors'])
 supported_pt_extensions = set(['.ckpt', '.pt', '.bin', '.pth', '.safetensors'])
@@ -35,6 +37,9 @@ temp_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "temp
 input_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "input")
 
 filename_list_cache = {}
+folder_change_counter = 0
+file_hash_cache = {}
+file_hash_mutex = threading.Lock()
 
 if not os.path.exists(input_directory):
     os.makedirs(input_directory)
@@ -181,6 +186,28 @@ def cached_filename_list_(folder_name):
 
     return out
 
+def folders_changed():
+    #call this after adding or removing files so anything cached from the folder contents gets refreshed
+    global folder_change_counter
+    folder_change_counter += 1
+    filename_list_cache.clear()
+
+def get_folder_state():
+    """
+    Returns a value that changes when the content of the input folder or of one of the
+    model folders listed with get_filename_list changes.
+    """
+    global folder_change_counter
+    for folder_name in list(filename_list_cache.keys()):
+        if cached_filename_list_(folder_name) is None:
+            filename_list_cache.pop(folder_name, None)
+            folder_change_counter += 1
+    try:
+        input_mtime = os.stat(get_input_directory()).st_mtime_ns
+    except OSError:
+        input_mtime = None
+    return (folder_change_counter, input_mtime)
+
 def get_filename_list(folder_name):
     out = cached_filename_list_(folder_name)
     if out is None:
@@ -189,6 +216,47 @@ def get_filename_list(folder_name):
         filename_list_cache[folder_name] = out
     return list(out[0])
 
+def get_file_hash(file_path):
+    """
+    Returns the sha256 hex digest of a file. Digests are cached by (path, size, mtime, inode)
+    so the file only gets read again after it changes. Meant for the IS_CHANGED of nodes
+    that load files.
+    """
+    file_path = os.path.abspath(file_path)
+    st = os.stat(file_path)
+    key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    with file_hash_mutex:
+        cached = file_hash_cache.get(file_path, None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    m = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            m.update(chunk)
+    digest = m.digest().hex()
+    with file_hash_mutex:
+        file_hash_cache[file_path] = (key, digest)
+    return digest
+
+def get_file_fingerprint(file_path):
+    st = os.stat(file_path)
+    return (st.st_size, st.st_mtime_ns)
+
+def get_model_file_fingerprint(filename):
+    """
+    Returns (folder_name, fingerprint) for a model file name like the ckpt_name of a checkpoint loader,
+    looked up in the folders that were listed with get_filename_list. None if it isn't a known model file.
+    """
+    for folder_name in list(filename_list_cache.keys()):
+        out = filename_list_cache.get(folder_name, None)
+        if out is None or filename not in out[0]:
+            continue
+        full_path = get_full_path(folder_name, filename)
+        if full_path is not None:
+            return (folder_name, get_file_fingerprint(full_path))
+    return None
+
 def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
     def map_filename(filename):
         prefix_len = len(os.path.basename(filename_prefix))
@@ -0,0 +1,101 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+
+def encode_entry(entry):
+    """
+    Serializes a history entry for HistoryStore.add. Values json can't handle are stored as their
+    string, if the entry still can't be serialized only its prompt is kept with the error.
+    """
+    try:
+        return json.dumps(entry, default=str)
+    except Exception as e:
+        print("Failed to serialize the history entry:", e)
+        print(traceback.format_exc())
+        return json.dumps({"prompt": entry.get("prompt", None), "outputs": {}, "error": str(e)}, default=str)
+
+class HistoryStore:
+    """
+    Append only store for the history of executed prompts backed by sqlite, in memory
+    unless a database path is given. Entries are stored as json so every read returns
+    a fresh copy and nothing has to be deep copied while holding the queue lock.
+
+    Only the max_items most recent entries and the entries younger than max_age seconds
+    are kept, 0 disables either limit.
+    """
+    def __init__(self, path=":memory:", max_items=0, max_age=0):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.mutex = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, prompt_id TEXT UNIQUE NOT NULL, timestamp REAL NOT NULL, data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp)")
+        self.db.commit()
+        with self.mutex:
+            self.apply_retention()
+
+    def add(self, prompt_id, data):
+        #data is the entry serialized with encode_entry
+        with self.mutex:
+            self.db.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+            self.db.execute("INSERT INTO history (prompt_id, timestamp, data) VALUES (?, ?, ?)", (prompt_id, time.time(), data))
+            self.apply_retention()
+            self.db.commit()
+
+    def apply_retention(self):
+        if self.max_items > 0:
+            self.db.execute("DELETE FROM history WHERE seq NOT IN (SELECT seq FROM history ORDER BY seq DESC LIMIT ?)", (self.max_items,))
+        if self.max_age > 0:
+            self.db.execute("DELETE FROM history WHERE timestamp < ?", (time.time() - self.max_age,))
+
+    def get(self, prompt_id=None, offset=0, limit=None, since=None):
+        """
+        Returns a dict of prompt_id -> history entry ordered from the oldest to the most recent entry.
+        since only returns the entries added after that unix timestamp, offset and limit apply after it.
+        """
+        query = "SELECT prompt_id, data FROM history"
+        conditions = []
+        params = []
+        if prompt_id is not None:
+            conditions.append("prompt_id = ?")
+            params.append(prompt_id)
+        if since is not None:
+            conditions.append("timestamp > ?")
+            params.append(since)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY seq LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+
+        with self.mutex:
+            rows = self.db.execute(query, params).fetchall()
+        return {x[0]: json.loads(x[1]) for x in rows}
+
+    def get_existing(self, prompt_ids):
+        #the subset of prompt_ids that have a history entry
+        out = set()
+        with self.mutex:
+            for i in range(0, len(prompt_ids), 500):
+                chunk = prompt_ids[i:i + 500]
+                rows = self.db.execute("SELECT prompt_id FROM history WHERE prompt_id IN ({})".format(",".join("?" * len(chunk))), chunk).fetchall()
+                out.update(x[0] for x in rows)
+        return out
+
+    def count(self):
+        with self.mutex:
+            return self.db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def delete(self, prompt_id):
+        with self.mutex:
+            self.db.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+            self.db.commit()
+
+    def clear(self):
+        with self.mutex:
+            self.db.execute("DELETE FROM history")
+            self.db.commit()
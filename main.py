@@ -44,6 +44,7 @@ execute_prestartup_script()
 
 
 # Main code
+import sys
 import asyncio
 import itertools
 import shutil
@@ -67,6 +68,7 @@ import comfy.utils
 import yaml
 
 import execution
+import output_writer
 import server
 from server import BinaryEventTypes
 from nodes import init_custom_nodes
@@ -75,17 +77,31 @@ import comfy.model_management
 def prompt_worker(q, server):
     e = execution.PromptExecutor(server)
     while True:
-        item, item_id = q.get()
-        execution_start_time = time.perf_counter()
-        prompt_id = item[1]
-        e.execute(item[2], prompt_id, item[3], item[4])
-        q.task_done(item_id, e.outputs_ui)
-        if server.client_id is not None:
-            server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
-
-        print("Prompt executed in {:.2f} seconds".format(time.perf_counter() - execution_start_time))
-        gc.collect()
-        comfy.model_management.soft_empty_cache()
+        batch = [q.get()]
+        if args.seed_batch_size > 1:
+            batch += q.get_seed_batch(batch[0][0], args.seed_batch_size - 1)
+            if len(batch) > 1:
+                print("Sampling {} prompts that only differ by their seeds in a single batch".format(len(batch)))
+                e.prepare_seed_batch([x[0] for x in batch])
+
+        try:
+            for item, item_id in batch:
+                execution_start_time = time.perf_counter()
+                prompt_id = item[1]
+                output_writer.set_current_prompt(prompt_id)
+                e.execute(item[2], prompt_id, item[3], item[4])
+                outputs_ui = e.outputs_ui
+                profile = e.profile
+                output_writer.when_flushed(prompt_id, lambda item_id=item_id, outputs_ui=outputs_ui, profile=profile: q.task_done(item_id, outputs_ui, profile))
+                if server.client_id is not None:
+                    server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
+
+                print("Prompt executed in {:.2f} seconds".format(time.perf_counter() - execution_start_time))
+                gc.collect()
+                comfy.model_management.soft_empty_cache()
+        finally:
+            #seed batch results of prompts that never got to their sampler don't stay pinned in the cache
+            e.release_pinned([x[0][1] for x in batch])
 
 async def run(server, address='', port=8188, verbose=True, call_on_start=None):
     await asyncio.gather(server.start(address, port, verbose, call_on_start), server.publish_loop())
@@ -126,27 +142,47 @@ def load_extra_path_config(yaml_path):
                 folder_paths.add_model_folder_path(x, full_path)
 
 
+def load_extra_model_paths():
+    extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
+    if os.path.isfile(extra_model_paths_config_path):
+        load_extra_path_config(extra_model_paths_config_path)
+
+    if args.extra_model_paths_config:
+        for config_path in itertools.chain(*args.extra_model_paths_config):
+            load_extra_path_config(config_path)
+
+
+def init_worker():
+    load_extra_model_paths()
+    if args.output_directory:
+        folder_paths.set_output_directory(os.path.abspath(args.output_directory))
+
+
 if __name__ == "__main__":
     cleanup_temp()
 
+    if args.batch is not None:
+        import batch_runner
+        exit_code = batch_runner.run(args.batch, args.batch_output, args.workers, init=init_worker, threads=args.worker_threads)
+        cleanup_temp()
+        sys.exit(exit_code)
+
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
     q = execution.PromptQueue(server)
 
-    extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
-    if os.path.isfile(extra_model_paths_config_path):
-        load_extra_path_config(extra_model_paths_config_path)
-
-    if args.extra_model_paths_config:
-        for config_path in itertools.chain(*args.extra_model_paths_config):
-            load_extra_path_config(config_path)
+    load_extra_model_paths()
 
     init_custom_nodes()
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    if args.workers > 1:
+        import worker_pool
+        pool = worker_pool.WorkerPool(q, server, args.workers, threads=args.worker_threads, init=init_worker)
+    else:
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
 
     if args.output_directory:
         output_dir = os.path.abspath(args.output_directory)
@@ -0,0 +1,107 @@
+import os
+import threading
+import queue
+import collections
+
+import psutil
+
+import folder_paths
+import comfy.utils
+from comfy.cli_args import args
+
+#the model folders the file name inputs of the loader nodes refer to
+MODEL_INPUTS = {
+    "ckpt_name": ["checkpoints"],
+    "lora_name": ["loras"],
+    "vae_name": ["vae"],
+    "control_net_name": ["controlnet"],
+    "clip_name": ["clip", "clip_vision"],
+    "clip_name1": ["clip"],
+    "clip_name2": ["clip"],
+    "unet_name": ["unet"],
+    "model_name": ["upscale_models"],
+    "style_model_name": ["style_models"],
+    "gligen_name": ["gligen"],
+    "hypernetwork_name": ["hypernetworks"],
+}
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def get_model_files(prompt):
+    files = []
+    for unique_id in prompt:
+        inputs = prompt[unique_id]['inputs']
+        for x in MODEL_INPUTS:
+            if not isinstance(inputs.get(x, None), str):
+                continue
+            for folder_name in MODEL_INPUTS[x]:
+                full_path = folder_paths.get_full_path(folder_name, inputs[x])
+                if full_path is not None:
+                    files.append(full_path)
+                    break
+    return files
+
+class ModelPrefetcher:
+    """
+    Reads the model files of the prompt that is going to be executed next on a background thread
+    so they are in the OS page cache when its loader nodes run. Files bigger than half the available
+    memory are skipped since they would just push each other out of the cache.
+
+    When the state dict cache is enabled (--state-dict-cache-size) the safetensors files that fit in
+    it are also loaded into it, so the loader nodes don't have to load them at all. A file that is
+    already being loaded is left to that load, and with --workers the state dicts are only loaded
+    by the worker processes.
+    """
+    def __init__(self, max_remembered=64):
+        self.prompts = queue.Queue()
+        self.done = collections.OrderedDict()
+        self.max_remembered = max_remembered
+        threading.Thread(target=self.worker, daemon=True, name="model_prefetch").start()
+
+    def prefetch_prompt(self, prompt):
+        self.prompts.put(prompt)
+
+    def worker(self):
+        while True:
+            prompt = self.prompts.get()
+            for file_path in get_model_files(prompt):
+                try:
+                    self.prefetch_file(file_path)
+                except Exception as e:
+                    print("Error prefetching model file:", file_path, e)
+
+    def prefetch_file(self, file_path):
+        fingerprint = (file_path,) + folder_paths.get_file_fingerprint(file_path)
+        if fingerprint in self.done:
+            self.done.move_to_end(fingerprint)
+            return
+        if fingerprint[1] > psutil.virtual_memory().available // 2:
+            return
+
+        with open(file_path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            buf = bytearray(CHUNK_SIZE)
+            while f.readinto(buf) > 0:
+                pass
+
+        #other files are pickles that are only safe to load in the loader nodes that ask for them
+        state_dict_cache = comfy.utils.state_dict_cache
+        if args.workers <= 1 and file_path.lower().endswith(".safetensors") and fingerprint[1] <= state_dict_cache.size_budget:
+            if not state_dict_cache.is_loading(state_dict_cache.get_key(file_path)):
+                comfy.utils.load_torch_file(file_path)
+
+        self.done[fingerprint] = True
+        if len(self.done) > self.max_remembered:
+            self.done.popitem(last=False)
+
+prefetcher = None
+if args.prefetch_models:
+    prefetcher = ModelPrefetcher()
+
+def prefetch_prompt(prompt):
+    if prefetcher is not None:
+        prefetcher.prefetch_prompt(prompt)
+
+def enabled():
+    return prefetcher is not None
@@ -3,11 +3,11 @@ import torch
 import os
 import sys
 import json
-import hashlib
 import traceback
 import math
 import time
 import random
+import threading
 
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
@@ -21,6 +21,7 @@ import comfy.diffusers_load
 import comfy.samplers
 import comfy.sample
 import comfy.sd
+import comfy.model_detection
 import comfy.utils
 
 import comfy.clip_vision
@@ -32,6 +33,7 @@ import importlib
 
 import folder_paths
 import latent_preview
+import output_writer
 
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
@@ -41,6 +43,13 @@ def interrupt_processing(value=True):
 
 MAX_RESOLUTION=8192
 
+save_image_lock = threading.Lock()
+
+def save_png(file_path, image, metadata=None):
+    i = 255. * image.cpu().numpy()
+    img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
+    img.save(file_path, pnginfo=metadata, compress_level=4)
+
 class CLIPTextEncode:
     @classmethod
     def INPUT_TYPES(s):
@@ -391,6 +400,7 @@ class LoadLatent:
 
     RETURN_TYPES = ("LATENT", )
     FUNCTION = "load"
+    THREAD_SAFE = True
 
     def load(self, latent):
         latent_path = folder_paths.get_annotated_filepath(latent)
@@ -404,10 +414,7 @@ class LoadLatent:
     @classmethod
     def IS_CHANGED(s, latent):
         image_path = folder_paths.get_annotated_filepath(latent)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, latent):
@@ -416,6 +423,17 @@ class LoadLatent:
         return True
 
 
+def validate_checkpoint(ckpt_name):
+    #the model type comes from the safetensors header or the detection cache so a file that isn't
+    #a supported model gets rejected before the prompt is queued, the file list is checked by validate_inputs
+    try:
+        detected = comfy.model_detection.detect_checkpoint(folder_paths.get_full_path("checkpoints", ckpt_name))
+    except Exception as e:
+        return "Invalid checkpoint file: {}: {}".format(ckpt_name, e)
+    if detected is not None and detected["model_config"] is None:
+        return "Could not detect model type of: {}".format(ckpt_name)
+    return True
+
 class CheckpointLoader:
     @classmethod
     def INPUT_TYPES(s):
@@ -438,12 +456,18 @@ class CheckpointLoaderSimple:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE")
     FUNCTION = "load_checkpoint"
+    LAZY_OUTPUTS = {0: "output_model", 1: "output_clip", 2: "output_vae"}
+    VALIDATE_COMBO_INPUTS = True
 
     CATEGORY = "loaders"
 
-    def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
+    @classmethod
+    def VALIDATE_INPUTS(s, ckpt_name):
+        return validate_checkpoint(ckpt_name)
+
+    def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True, output_model=True):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=output_vae, output_clip=output_clip, output_model=output_model, embedding_directory=folder_paths.get_folder_paths("embeddings"))
         return out
 
 class DiffusersLoader:
@@ -480,12 +504,18 @@ class unCLIPCheckpointLoader:
                              }}
     RETURN_TYPES = ("MODEL", "CLIP", "VAE", "CLIP_VISION")
     FUNCTION = "load_checkpoint"
+    LAZY_OUTPUTS = {0: "output_model", 1: "output_clip", 2: "output_vae", 3: "output_clipvision"}
+    VALIDATE_COMBO_INPUTS = True
 
     CATEGORY = "loaders"
 
-    def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True):
+    @classmethod
+    def VALIDATE_INPUTS(s, ckpt_name):
+        return validate_checkpoint(ckpt_name)
+
+    def load_checkpoint(self, ckpt_name, output_vae=True, output_clip=True, output_model=True, output_clipvision=True):
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
-        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=True, embedding_directory=folder_paths.get_folder_paths("embeddings"))
+        out = comfy.sd.load_checkpoint_guess_config(ckpt_path, output_vae=output_vae, output_clip=output_clip, output_clipvision=output_clipvision, output_model=output_model, embedding_directory=folder_paths.get_folder_paths("embeddings"))
         return out
 
 class CLIPSetLastLayer:
@@ -1146,11 +1176,13 @@ class SetLatentNoiseMask:
         return (s,)
 
 
-def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False):
+def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False, noise=None):
     device = comfy.model_management.get_torch_device()
     latent_image = latent["samples"]
 
-    if disable_noise:
+    if noise is not None:
+        pass
+    elif disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
@@ -1180,6 +1212,40 @@ def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive,
     out["samples"] = samples
     return (out, )
 
+#samplers that treat each latent of a batch on its own without drawing more noise while sampling, sampling a batch of
+#seeds with them gives the same results as sampling each seed on its own. The ancestral and sde ones draw more noise and
+#dpm_fast/dpm_adaptive pick their steps from an error estimate over the whole batch.
+SEED_BATCH_SAMPLERS = ["euler", "heun", "dpm_2", "lms", "dpmpp_2m", "ddim", "uni_pc", "uni_pc_bh2"]
+
+def seed_batch_supported(sampler_name):
+    return sampler_name in SEED_BATCH_SAMPLERS
+
+def common_ksampler_seed_batch(model, seeds, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False):
+    latent_image = latent["samples"]
+    batch_size = latent_image.shape[0]
+
+    if disable_noise:
+        noise = torch.zeros([batch_size * len(seeds)] + list(latent_image.size())[1:], dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    else:
+        batch_inds = latent["batch_index"] if "batch_index" in latent else None
+        noise = torch.cat([comfy.sample.prepare_noise(latent_image, seed, batch_inds) for seed in seeds])
+
+    batched = latent.copy()
+    batched["samples"] = latent_image.repeat(len(seeds), 1, 1, 1)
+    if "noise_mask" in latent:
+        noise_mask = latent["noise_mask"]
+        noise_mask = noise_mask.reshape((-1, 1, noise_mask.shape[-2], noise_mask.shape[-1]))
+        noise_mask = noise_mask.repeat(math.ceil(batch_size / noise_mask.shape[0]), 1, 1, 1)[:batch_size]
+        batched["noise_mask"] = noise_mask.repeat(len(seeds), 1, 1, 1)
+
+    samples = common_ksampler(model, seeds[0], steps, cfg, sampler_name, scheduler, positive, negative, batched, denoise=denoise, disable_noise=disable_noise, start_step=start_step, last_step=last_step, force_full_denoise=force_full_denoise, noise=noise)[0]["samples"]
+    out = []
+    for i in range(len(seeds)):
+        o = latent.copy()
+        o["samples"] = samples[i * batch_size:(i + 1) * batch_size]
+        out.append(o)
+    return out
+
 class KSampler:
     @classmethod
     def INPUT_TYPES(s):
@@ -1200,11 +1266,20 @@ class KSampler:
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
 
+    SEED_BATCH_INPUT = "seed"
+    SEED_BATCH_FUNCTION = "sample_seed_batch"
+
     CATEGORY = "sampling"
 
     def sample(self, model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
 
+    def sample_seed_batch(self, seeds, model, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0):
+        if not seed_batch_supported(sampler_name):
+            return None
+        out = common_ksampler_seed_batch(model, seeds, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
+        return [(o, ) for o in out]
+
 class KSamplerAdvanced:
     @classmethod
     def INPUT_TYPES(s):
@@ -1228,6 +1303,9 @@ class KSamplerAdvanced:
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "sample"
 
+    SEED_BATCH_INPUT = "noise_seed"
+    SEED_BATCH_FUNCTION = "sample_seed_batch"
+
     CATEGORY = "sampling"
 
     def sample(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
@@ -1239,6 +1317,18 @@ class KSamplerAdvanced:
             disable_noise = True
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
 
+    def sample_seed_batch(self, seeds, model, add_noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0):
+        if not seed_batch_supported(sampler_name):
+            return None
+        force_full_denoise = True
+        if return_with_leftover_noise == "enable":
+            force_full_denoise = False
+        disable_noise = False
+        if add_noise == "disable":
+            disable_noise = True
+        out = common_ksampler_seed_batch(model, seeds, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
+        return [(o, ) for o in out]
+
 class SaveImage:
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
@@ -1257,33 +1347,41 @@ class SaveImage:
     FUNCTION = "save_images"
 
     OUTPUT_NODE = True
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+        metadata = None
+        if not args.disable_metadata:
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add_text("prompt", json.dumps(prompt))
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
         results = list()
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
-            file = f"{filename}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=4)
-            results.append({
-                "filename": file,
-                "subfolder": subfolder,
-                "type": self.type
-            })
-            counter += 1
+        file_paths = list()
+        # the file counter is found by listing the output folder so two nodes saving at the same time would pick the same one,
+        # the file names are reserved under the lock and the images are encoded outside of it
+        with save_image_lock:
+            full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
+            for image in images:
+                file = f"{filename}_{counter:05}_.png"
+                file_path = os.path.join(full_output_folder, file)
+                open(file_path, "wb").close()
+                file_paths.append(file_path)
+                results.append({
+                    "filename": file,
+                    "subfolder": subfolder,
+                    "type": self.type
+                })
+                counter += 1
+
+        for image, file_path in zip(images, file_paths):
+            output_writer.write(file_path, save_png, image, metadata)
 
         return { "ui": { "images": results } }
 
@@ -1313,6 +1411,7 @@ class LoadImage:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    THREAD_SAFE = True
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         i = Image.open(image_path)
@@ -1330,10 +1429,7 @@ class LoadImage:
     @classmethod
     def IS_CHANGED(s, image):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1357,6 +1453,7 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    THREAD_SAFE = True
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = Image.open(image_path)
@@ -1377,10 +1474,7 @@ class LoadImageMask:
     @classmethod
     def IS_CHANGED(s, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(image_path)
 
     @classmethod
     def VALIDATE_INPUTS(s, image, channel):
@@ -1404,6 +1498,7 @@ class ImageScale:
                               "crop": (s.crop_methods,)}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    THREAD_SAFE = True
 
     CATEGORY = "image/upscaling"
 
@@ -1422,6 +1517,7 @@ class ImageScaleBy:
                               "scale_by": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 8.0, "step": 0.01}),}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    THREAD_SAFE = True
 
     CATEGORY = "image/upscaling"
 
@@ -1441,6 +1537,7 @@ class ImageInvert:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "invert"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -1466,6 +1563,7 @@ class ImagePadForOutpaint:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "expand_image"
+    THREAD_SAFE = True
 
     CATEGORY = "image"
 
@@ -0,0 +1,100 @@
+import os
+import threading
+import queue
+import traceback
+
+from comfy.cli_args import args
+
+class OutputWriter:
+    """
+    Writes output files on background threads so the executor can move on to the next node
+    or prompt. The queue is bounded so a slow disk blocks the nodes submitting writes instead
+    of piling up images in memory.
+
+    Writes are grouped by the prompt that was executing when they were submitted so the prompt
+    can be finalized once all its files are on disk, see when_flushed.
+    """
+    def __init__(self, num_workers=1, max_pending=16):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.mutex = threading.RLock()
+        self.file_written = threading.Condition(self.mutex)
+        self.current_prompt_id = None
+        self.pending_prompts = {}
+        self.pending_files = set()
+        self.flush_callbacks = {}
+        for i in range(num_workers):
+            threading.Thread(target=self.worker, daemon=True, name="output_writer_{}".format(i)).start()
+
+    def set_current_prompt(self, prompt_id):
+        with self.mutex:
+            self.current_prompt_id = prompt_id
+
+    def submit(self, path, function, *args):
+        path = os.path.abspath(path)
+        with self.mutex:
+            prompt_id = self.current_prompt_id
+            self.pending_prompts[prompt_id] = self.pending_prompts.get(prompt_id, 0) + 1
+            self.pending_files.add(path)
+        self.jobs.put((prompt_id, path, function, args))
+
+    def worker(self):
+        while True:
+            prompt_id, path, function, args = self.jobs.get()
+            try:
+                function(path, *args)
+            except Exception as e:
+                print(traceback.format_exc())
+                print("Error writing output file:", path, e)
+
+            callbacks = []
+            with self.mutex:
+                self.pending_files.discard(path)
+                self.pending_prompts[prompt_id] -= 1
+                if self.pending_prompts[prompt_id] == 0:
+                    self.pending_prompts.pop(prompt_id)
+                    callbacks = self.flush_callbacks.pop(prompt_id, [])
+                self.file_written.notify_all()
+
+            for c in callbacks:
+                c()
+
+    def when_flushed(self, prompt_id, callback):
+        with self.mutex:
+            if prompt_id in self.pending_prompts:
+                self.flush_callbacks.setdefault(prompt_id, []).append(callback)
+                return
+        callback()
+
+    def wait_for_file(self, path, timeout=None):
+        path = os.path.abspath(path)
+        with self.file_written:
+            return self.file_written.wait_for(lambda: path not in self.pending_files, timeout=timeout)
+
+writer = None
+if args.output_writer_threads > 0:
+    writer = OutputWriter(num_workers=args.output_writer_threads, max_pending=args.output_writer_threads * 8)
+
+def enabled():
+    return writer is not None
+
+def set_current_prompt(prompt_id):
+    if writer is not None:
+        writer.set_current_prompt(prompt_id)
+
+def write(path, function, *args):
+    #calls function(path, *args) on a writer thread, or right away if the background writer is disabled
+    if writer is not None:
+        writer.submit(path, function, *args)
+    else:
+        function(path, *args)
+
+def when_flushed(prompt_id, callback):
+    if writer is not None:
+        writer.when_flushed(prompt_id, callback)
+    else:
+        callback()
+
+def wait_for_file(path, timeout=None):
+    if writer is not None:
+        return writer.wait_for_file(path, timeout=timeout)
+    return True
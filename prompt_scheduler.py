@@ -0,0 +1,286 @@
+import math
+import time
+
+#costs are in sampling steps of a single 512x512 image
+DEFAULT_IMAGE_SIZE = (512, 512, 1)
+MODEL_LOAD_COST = 30.0
+LORA_PATCH_COST = 5.0
+VAE_COST = 1.0
+UPSCALE_TILE_COST = 2.0
+UPSCALE_MODEL_SCALE = 4
+
+SIZE_INPUTS = ["samples", "latent_image", "latent", "pixels", "image", "images"]
+
+def get_number(inputs, name, default):
+    value = inputs.get(name, default)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return default
+
+def resize(node, size):
+    class_type = node['class_type']
+    inputs = node['inputs']
+    width, height, batch = size
+    if class_type in ("LatentUpscale", "ImageScale"):
+        return (get_number(inputs, "width", width), get_number(inputs, "height", height), batch)
+    if class_type in ("LatentUpscaleBy", "ImageScaleBy"):
+        scale = get_number(inputs, "scale_by", 1.0)
+        return (width * scale, height * scale, batch)
+    if class_type == "RepeatLatentBatch":
+        return (width, height, batch * get_number(inputs, "amount", 1))
+    if class_type == "ImageUpscaleWithModel":
+        return (width * UPSCALE_MODEL_SCALE, height * UPSCALE_MODEL_SCALE, batch)
+    return size
+
+def get_image_size(prompt, unique_id, sizes):
+    """
+    Best guess of the (width, height, batch) in pixels of the latent or image output of a node,
+    found by following the latent and image links up to an EmptyLatentImage.
+    """
+    path = []
+    size = DEFAULT_IMAGE_SIZE
+    while unique_id not in sizes:
+        node = prompt.get(unique_id, None)
+        if node is None or len(path) > len(prompt):
+            break
+        inputs = node['inputs']
+        if node['class_type'] == "EmptyLatentImage":
+            sizes[unique_id] = (get_number(inputs, "width", 512), get_number(inputs, "height", 512), get_number(inputs, "batch_size", 1))
+            break
+        path.append(unique_id)
+        links = [inputs[x] for x in SIZE_INPUTS if isinstance(inputs.get(x, None), list)]
+        if len(links) == 0:
+            break
+        unique_id = links[0][0]
+
+    if unique_id in sizes:
+        size = sizes[unique_id]
+    for x in reversed(path):
+        size = resize(prompt[x], size)
+        sizes[x] = size
+    return size
+
+def get_input_size(prompt, node, sizes):
+    inputs = node['inputs']
+    for x in SIZE_INPUTS:
+        if isinstance(inputs.get(x, None), list):
+            return get_image_size(prompt, inputs[x][0], sizes)
+    return DEFAULT_IMAGE_SIZE
+
+def get_models(inputs):
+    #the models a node loads, loras with their strengths since they get patched into the model
+    models = []
+    for x in ("ckpt_name", "unet_name"):
+        if isinstance(inputs.get(x, None), str):
+            models.append((x, inputs[x]))
+    if isinstance(inputs.get("lora_name", None), str):
+        models.append(("lora_name", inputs["lora_name"], get_number(inputs, "strength_model", None), get_number(inputs, "strength_clip", None)))
+    return models
+
+def load_cost(models):
+    return sum(LORA_PATCH_COST if x[0] == "lora_name" else MODEL_LOAD_COST for x in models)
+
+def estimate_cost(prompt):
+    """
+    Rough estimate of the work needed to execute a prompt, in sampling steps of a 512x512 image,
+    without the cost of loading models. Also returns the models and loras the prompt needs.
+    """
+    sizes = {}
+    cost = 0.0
+    models = set()
+    for unique_id, node in prompt.items():
+        class_type = node['class_type']
+        inputs = node['inputs']
+        models.update(get_models(inputs))
+
+        if isinstance(get_number(inputs, "steps", None), int) and isinstance(inputs.get("latent_image", None), list):
+            steps = inputs["steps"]
+            start = get_number(inputs, "start_at_step", 0)
+            end = min(get_number(inputs, "end_at_step", steps), steps)
+            width, height, batch = get_input_size(prompt, node, sizes)
+            cost += max(end - start, 0) * (width * height) / (512 * 512) * batch
+        elif class_type.startswith("VAEDecode") or class_type.startswith("VAEEncode"):
+            width, height, batch = get_input_size(prompt, node, sizes)
+            cost += VAE_COST * (width * height) / (512 * 512) * batch
+        elif class_type == "ImageUpscaleWithModel":
+            width, height, batch = get_input_size(prompt, node, sizes)
+            cost += UPSCALE_TILE_COST * math.ceil(width / 512) * math.ceil(height / 512) * batch
+    return cost, frozenset(models)
+
+class PromptScheduler:
+    """
+    Picks the next queue item to execute with one of these policies:
+
+    fifo: by the number the prompt was queued with.
+    sjf: the prompt with the lowest estimated cost first.
+    fair: weighted fair queueing between the client_id of the prompts, the client that used
+          the least cost divided by its weight goes next.
+    affinity: the prompts needing the least model loads and lora patches on top of the models
+              of the last executed prompt first, so prompts using the same models run together.
+
+    With sjf and affinity a prompt can only be passed over by newer prompts max_skips times
+    before it runs, so it can't be starved.
+
+    The cost estimates are also used to give an ETA for queued prompts, the seconds per cost
+    unit are measured from the executed prompts.
+    """
+    def __init__(self, policy="fifo", client_weights={}, max_skips=8):
+        self.policy = policy
+        self.client_weights = client_weights
+        self.max_skips = max_skips
+        self.skips = {}
+        self.info = {}
+        self.served = {}
+        self.pending_clients = {}
+        self.loaded_models = frozenset()
+        self.running = {}
+        self.seconds_per_cost = 0.1
+
+    def get_client(self, item):
+        return item[3].get("client_id", None)
+
+    def add(self, item):
+        cost, models = estimate_cost(item[2])
+        client = self.get_client(item)
+        self.info[item[1]] = (cost, models, client)
+
+        if self.pending_clients.get(client, 0) == 0:
+            # a client that was idle starts at the usage of the least served waiting client so it can't save up
+            waiting = [self.served.get(c, 0.0) for c in self.pending_clients if self.pending_clients[c] > 0]
+            self.served[client] = max(self.served.get(client, 0.0), min(waiting, default=0.0))
+        self.pending_clients[client] = self.pending_clients.get(client, 0) + 1
+
+    def remove(self, item):
+        self.skips.pop(item[1], None)
+        info = self.info.pop(item[1], None)
+        if info is not None:
+            client = info[2]
+            self.pending_clients[client] -= 1
+            if self.pending_clients[client] == 0:
+                self.pending_clients.pop(client)
+        return info
+
+    def cost(self, item):
+        cost, models, client = self.info[item[1]]
+        return cost + load_cost(models - self.loaded_models)
+
+    def pending_by_client(self):
+        #client_id -> (number of queued prompts, their estimated cost)
+        out = {}
+        for cost, models, client in self.info.values():
+            count, total = out.get(client, (0, 0.0))
+            out[client] = (count + 1, total + cost + load_cost(models - self.loaded_models))
+        return out
+
+    def weight(self, client):
+        return self.client_weights.get(client, 1.0)
+
+    def sort_key(self, item):
+        #the sjf and affinity policies pick the item with the lowest key
+        if self.policy == "sjf":
+            return (self.cost(item), item[0], item[1])
+        return (load_cost(self.info[item[1]][1] - self.loaded_models), item[0], item[1])
+
+    def choose(self, queue, skips, served, keys=None):
+        """
+        The item of queue that runs next given the skip counts and the client usage. select and peek
+        both pick with this so the prefetched prompt is the one that runs.
+        keys can map the prompt ids to their sort_key so they are not computed again.
+        """
+        if self.policy in ("sjf", "affinity"):
+            starved = [a for a in queue if skips.get(a[1], 0) >= self.max_skips]
+            if len(starved) > 0:
+                return min(starved, key=lambda a: (a[0], a[1]))
+            if keys is not None:
+                return min(queue, key=lambda a: keys[a[1]])
+            return min(queue, key=self.sort_key)
+        if self.policy == "fair":
+            clients = set(self.info[a[1]][2] for a in queue)
+            client = min(clients, key=lambda c: (served.get(c, 0.0), str(c)))
+            return min([a for a in queue if self.info[a[1]][2] == client], key=lambda a: (a[0], a[1]))
+        return min(queue, key=lambda a: (a[0], a[1]))
+
+    def pass_over(self, queue, selected, skips):
+        #the items queued before the selected one were skipped once more
+        if self.policy in ("sjf", "affinity"):
+            for a in queue:
+                if (a[0], a[1]) < (selected[0], selected[1]):
+                    skips[a[1]] = skips.get(a[1], 0) + 1
+
+    def select(self, queue):
+        if self.policy == "fifo":
+            return queue[0]
+        selected = self.choose(queue, self.skips, self.served)
+        self.pass_over(queue, selected, self.skips)
+        return selected
+
+    def peek(self, queue):
+        #the item expected to run next, unlike select this doesn't count as passing over the other items
+        if self.policy == "fifo":
+            return queue[0]
+        return self.choose(queue, self.skips, self.served)
+
+    def ahead(self, target, queue):
+        """
+        The queue items expected to run before target. Worked out from the sort keys and the client
+        usage with the same rules as choose instead of replaying select for every item.
+        """
+        age = (target[0], target[1])
+        if self.policy in ("sjf", "affinity"):
+            keys = {a[1]: self.sort_key(a) for a in queue}
+            key = keys[target[1]]
+            #target runs at the latest once it has been passed over max_skips times
+            newer = sorted([a for a in queue if (a[0], a[1]) > age and keys[a[1]] < key], key=lambda a: keys[a[1]])
+            out = newer[:max(self.max_skips - self.skips.get(target[1], 0), 0)]
+            #an older item runs first if its key is lower or if it starves from the items running before target that are newer than it
+            for a in sorted([a for a in queue if (a[0], a[1]) < age], key=lambda a: (a[0], a[1]), reverse=True):
+                if keys[a[1]] < key or self.max_skips - self.skips.get(a[1], 0) <= len(out):
+                    out.append(a)
+            return out
+        if self.policy == "fair":
+            #the usage of each client when each of its items would start, the client with the lowest goes next
+            starts = {}
+            used = {}
+            for a in sorted(queue, key=lambda a: (a[0], a[1])):
+                client = self.info[a[1]][2]
+                start = used.get(client, self.served.get(client, 0.0))
+                starts[a[1]] = (start, str(client), a[0], a[1])
+                used[client] = start + self.cost(a) / self.weight(client)
+            return [a for a in queue if starts[a[1]] < starts[target[1]]]
+        return [a for a in queue if (a[0], a[1]) < age]
+
+    def started(self, item):
+        cost = self.cost(item)
+        cost_info = self.remove(item)
+        if cost_info is None:
+            return
+        client = cost_info[2]
+        self.served[client] = self.served.get(client, 0.0) + cost / self.weight(client)
+        if len(cost_info[1]) > 0:
+            self.loaded_models = cost_info[1]
+        self.running[item[1]] = (time.perf_counter(), cost)
+
+    def finished(self, prompt_id):
+        start = self.running.pop(prompt_id, None)
+        if start is None:
+            return
+        start_time, cost = start
+        if cost > 0:
+            self.seconds_per_cost = self.seconds_per_cost * 0.8 + ((time.perf_counter() - start_time) / cost) * 0.2
+
+    def eta(self, prompt_id, queue):
+        #estimated number of seconds until the prompt is done executing, it is called with the queue locked so it has to stay linear
+        target = None
+        for a in queue:
+            if a[1] == prompt_id:
+                target = a
+                break
+        if target is None:
+            return None
+        now = time.perf_counter()
+        total = 0.0
+        for start_time, cost in self.running.values():
+            total += max(cost * self.seconds_per_cost - (now - start_time), 0.0)
+        for a in self.ahead(target, queue) + [target]:
+            total += self.cost(a) * self.seconds_per_cost
+        return total
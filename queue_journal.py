@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+import time
+
+class QueueJournal:
+    """
+    Write ahead log of the prompt queue operations (put, get, task done, delete, wipe) so the
+    pending prompts survive a crash or restart, see replay.
+
+    Records are written to the file right away but only fsynced by a background thread every
+    sync_interval seconds, so appending a record never waits on the disk.
+    """
+    def __init__(self, path, sync_interval=0.05, max_attempts=2):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_attempts = max_attempts
+        self.mutex = threading.Lock()
+        self.dirty = threading.Event()
+        self.records = 0
+        self.file = None
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.sync_worker, daemon=True, name="queue_journal").start()
+
+    def replay(self):
+        """
+        Returns the queue items that were put and never finished or deleted. Items that were
+        running when the process stopped are returned again unless they already were started
+        max_attempts times, in case they are what crashed it. The journal is rewritten with
+        only those items.
+        """
+        pending = {}
+        attempts = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #a partially written last record
+                        continue
+                    op = record["op"]
+                    if op == "put":
+                        item = record["item"]
+                        pending[item[1]] = tuple(item)
+                        attempts[item[1]] = record.get("attempts", 0)
+                    elif op == "get":
+                        attempts[record["id"]] = attempts.get(record["id"], 0) + 1
+                    elif op in ("done", "delete"):
+                        pending.pop(record["id"], None)
+                    elif op == "wipe":
+                        for x in record["ids"]:
+                            pending.pop(x, None)
+
+        items = []
+        for prompt_id, item in pending.items():
+            if attempts.get(prompt_id, 0) >= self.max_attempts:
+                print("Dropping queued prompt {} from the queue journal, it was interrupted {} times.".format(prompt_id, attempts[prompt_id]))
+                continue
+            items.append(item)
+
+        self.compact(items, attempts)
+        return items
+
+    def compact(self, items, attempts={}):
+        temp_path = "{}.tmp".format(self.path)
+        with self.mutex:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps({"op": "put", "item": item, "attempts": attempts.get(item[1], 0)}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if self.file is not None:
+                self.file.close()
+            os.replace(temp_path, self.path)
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.records = len(items)
+
+    def append(self, record):
+        line = json.dumps(record) + "\n"
+        with self.mutex:
+            self.file.write(line)
+            self.records += 1
+        self.dirty.set()
+
+    def put(self, item):
+        self.append({"op": "put", "item": item})
+
+    def get(self, prompt_id):
+        self.append({"op": "get", "id": prompt_id})
+
+    def done(self, prompt_id):
+        self.append({"op": "done", "id": prompt_id})
+
+    def delete(self, prompt_id):
+        self.append({"op": "delete", "id": prompt_id})
+
+    def wipe(self, prompt_ids):
+        self.append({"op": "wipe", "ids": prompt_ids})
+
+    def sync(self):
+        with self.mutex:
+            if self.file is None:
+                return
+            self.file.flush()
+            fd = os.dup(self.file.fileno())
+        #fsync outside of the lock so appending records doesn't wait on it
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync_worker(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                print("Error syncing the queue journal:", e)
+            time.sleep(self.sync_interval)
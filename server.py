@@ -4,6 +4,7 @@ import asyncio
 import nodes
 import folder_paths
 import execution
+import output_writer
 import uuid
 import json
 import glob
@@ -27,6 +28,8 @@ import comfy.utils
 import comfy.model_management
 
 
+MAX_BATCH_SIZE = 1000
+
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
@@ -84,6 +87,7 @@ class PromptServer():
         self.routes = routes
         self.last_node_id = None
         self.client_id = None
+        self.interrupt_client_id = None
 
         @routes.get('/ws')
         async def websocket_handler(request):
@@ -177,6 +181,7 @@ class PromptServer():
                 else:
                     with open(filepath, "wb") as f:
                         f.write(image.file.read())
+                folder_paths.folders_changed()
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
@@ -253,6 +258,9 @@ class PromptServer():
                 filename = os.path.basename(filename)
                 file = os.path.join(output_dir, filename)
 
+                if output_writer.enabled():
+                    await self.loop.run_in_executor(None, output_writer.wait_for_file, file, 60.0)
+
                 if os.path.isfile(file):
                     if 'preview' in request.rel_url.query:
                         with Image.open(file) as img:
@@ -405,12 +413,25 @@ class PromptServer():
 
         @routes.get("/history")
         async def get_history(request):
-            return web.json_response(self.prompt_queue.get_history())
+            try:
+                offset = int(request.rel_url.query.get("offset", 0))
+                limit = request.rel_url.query.get("limit", None)
+                if limit is not None:
+                    limit = int(limit)
+                since = request.rel_url.query.get("since", None)
+                if since is not None:
+                    since = float(since)
+            except ValueError:
+                return web.Response(status=400)
+
+            history = await self.loop.run_in_executor(None, lambda: self.prompt_queue.get_history(offset=offset, limit=limit, since=since))
+            return web.json_response(history)
 
         @routes.get("/history/{prompt_id}")
         async def get_history(request):
             prompt_id = request.match_info.get("prompt_id", None)
-            return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
+            history = await self.loop.run_in_executor(None, lambda: self.prompt_queue.get_history(prompt_id=prompt_id))
+            return web.json_response(history)
 
         @routes.get("/queue")
         async def get_queue(request):
@@ -449,8 +470,14 @@ class PromptServer():
                 if valid[0]:
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
-                    self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
+                    item = (number, prompt_id, prompt, extra_data, outputs_to_execute)
+                    admission_error = self.prompt_queue.get_admission_error([item])
+                    if admission_error is not None:
+                        error, retry_after = admission_error
+                        print("prompt rejected:", error["message"])
+                        return web.json_response({"error": error, "node_errors": []}, status=429, headers={"Retry-After": str(retry_after)})
+                    self.prompt_queue.put(item)
+                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3], "eta": self.prompt_queue.get_eta(prompt_id)}
                     return web.json_response(response)
                 else:
                     print("invalid prompt:", valid[1])
@@ -458,6 +485,56 @@ class PromptServer():
             else:
                 return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+        @routes.post("/prompt/batch")
+        async def post_prompt_batch(request):
+            print("got prompt batch")
+            json_data =  await request.json()
+            if "prompt" not in json_data:
+                return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+
+            #copying and validating every prompt of a big batch would block the event loop
+            batch = await self.loop.run_in_executor(None, execution.validate_prompt_batch, json_data["prompt"],
+                                                    json_data.get("sweep", {}), json_data.get("variants", []), MAX_BATCH_SIZE)
+            if not batch[0]:
+                print("invalid prompt batch:", batch[1])
+                response = {"error": batch[1], "node_errors": batch[2]}
+                if batch[3] is not None:
+                    response["overrides"] = batch[3]
+                return web.json_response(response, status=400)
+            valid = batch[1]
+
+            extra_data = json_data.get("extra_data", {})
+            if "client_id" in json_data:
+                extra_data["client_id"] = json_data["client_id"]
+            batch_id = str(uuid.uuid4())
+
+            items = []
+            for p in batch[2]:
+                number = self.number
+                if json_data.get("front", False):
+                    number = -number
+                self.number += 1
+                items.append((number, str(uuid.uuid4()), p, dict(extra_data, batch_id=batch_id), valid[2]))
+
+            admission_error = self.prompt_queue.get_admission_error(items)
+            if admission_error is not None:
+                error, retry_after = admission_error
+                print("prompt batch rejected:", error["message"])
+                return web.json_response({"error": error, "node_errors": []}, status=429, headers={"Retry-After": str(retry_after)})
+
+            self.prompt_queue.add_batch(batch_id, [x[1] for x in items])
+            for item in items:
+                self.prompt_queue.put(item)
+            return web.json_response({"batch_id": batch_id, "prompt_ids": [x[1] for x in items], "node_errors": valid[3]})
+
+        @routes.get("/prompt/batch/{batch_id}")
+        async def get_prompt_batch(request):
+            batch_id = request.match_info.get("batch_id", None)
+            status = await self.loop.run_in_executor(None, self.prompt_queue.get_batch_status, batch_id)
+            if status is None:
+                return web.Response(status=404)
+            return web.json_response(status)
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
@@ -474,6 +551,14 @@ class PromptServer():
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
+            #the client_id of the requester decides which prompt gets interrupted when there are multiple workers
+            json_data = None
+            if request.can_read_body:
+                try:
+                    json_data = await request.json()
+                except ValueError:
+                    pass
+            self.interrupt_client_id = json_data.get("client_id", None) if isinstance(json_data, dict) else None
             nodes.interrupt_processing()
             return web.Response(status=200)
 
@@ -313,7 +313,7 @@ class ComfyApi extends EventTarget {
 	 * Interrupts the execution of the running prompt
 	 */
 	async interrupt() {
-		await this.#postItem("interrupt", null);
+		await this.#postItem("interrupt", { client_id: this.clientId });
 	}
 }
 
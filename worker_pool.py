@@ -0,0 +1,207 @@
+import os
+import gc
+import time
+import threading
+import traceback
+import multiprocessing
+
+from aiohttp import web
+
+import comfy.model_management
+
+class WorkerServer:
+    """
+    Stands in for the PromptServer in the worker processes, the messages are sent to the
+    parent process that forwards them to the websocket clients. It is also set as
+    PromptServer.instance for the custom nodes that use it.
+    """
+    def __init__(self, conn, send_mutex):
+        self.conn = conn
+        self.send_mutex = send_mutex
+        self.client_id = None
+        self.last_node_id = None
+        #routes the custom nodes add in a worker are only served by the main process
+        self.routes = web.RouteTableDef()
+
+    def send_sync(self, event, data, sid=None):
+        with self.send_mutex:
+            self.conn.send(("message", event, data, sid))
+
+    def queue_updated(self):
+        pass
+
+def worker_main(init, conn, threads):
+    import torch
+    import execution
+    import output_writer
+    import comfy.utils
+    from server import BinaryEventTypes, PromptServer
+    from nodes import init_custom_nodes, interrupt_processing
+
+    if threads > 0:
+        torch.set_num_threads(threads)
+    init()
+    #there is no PromptServer in a spawned worker, custom nodes use PromptServer.instance when they are imported and executed
+    send_mutex = threading.Lock()
+    server = WorkerServer(conn, send_mutex)
+    PromptServer.instance = server
+    init_custom_nodes()
+
+    def hook(value, total, preview_image):
+        server.send_sync("progress", {"value": value, "max": total}, server.client_id)
+        if preview_image is not None:
+            server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+    comfy.utils.set_progress_bar_global_hook(hook)
+    executor = execution.PromptExecutor(server)
+
+    #the pipe is read on its own thread so interrupts arrive while a prompt is executing
+    jobs = []
+    jobs_available = threading.Condition()
+    def reader():
+        while True:
+            try:
+                msg = conn.recv()
+            except EOFError:
+                msg = None
+            if msg is not None and msg[0] == "interrupt":
+                interrupt_processing()
+                continue
+            with jobs_available:
+                jobs.append(msg)
+                jobs_available.notify()
+            if msg is None:
+                break
+    threading.Thread(target=reader, daemon=True).start()
+
+    with send_mutex:
+        conn.send(("ready",))
+    while True:
+        with jobs_available:
+            jobs_available.wait_for(lambda: len(jobs) > 0)
+            job = jobs.pop(0)
+        if job is None:
+            break
+        _, prompt_id, prompt, extra_data, execute_outputs = job
+        output_writer.set_current_prompt(prompt_id)
+        executor.execute(prompt, prompt_id, extra_data, execute_outputs)
+        flushed = threading.Event()
+        output_writer.when_flushed(prompt_id, flushed.set)
+        flushed.wait()
+        with send_mutex:
+            conn.send(("done", executor.outputs_ui, executor.profile))
+        gc.collect()
+        comfy.model_management.soft_empty_cache()
+
+class WorkerProcess:
+    def __init__(self, context, init, threads):
+        self.send_mutex = threading.Lock()
+        self.busy = False
+        self.client_id = None
+        self.start_time = 0.0
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(init, child_conn, threads), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def send(self, msg):
+        with self.send_mutex:
+            self.conn.send(msg)
+
+    def wait_ready(self):
+        try:
+            return self.conn.recv()[0] == "ready"
+        except EOFError:
+            return False
+
+class WorkerPool:
+    """
+    Executes the prompts of a PromptQueue on num_workers processes, each limited to threads torch
+    threads (0 splits the cpu cores between them). The workers map the safetensors model files
+    (see comfy.utils.load_torch_file) so the processes share the pages of the weights. Messages
+    of the workers are forwarded to the websocket clients and interrupts to the worker executing
+    a prompt of the client that sent the interrupt. An interrupt without a client_id stops the
+    prompt that was started last.
+    """
+    def __init__(self, queue, server, num_workers, threads=0, init=lambda: None):
+        self.queue = queue
+        self.server = server
+        self.init = init
+        self.threads = threads
+        if self.threads <= 0:
+            self.threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []
+        self.mutex = threading.Lock()
+        for i in range(num_workers):
+            threading.Thread(target=self.dispatcher, daemon=True, name="worker_pool_{}".format(i)).start()
+        threading.Thread(target=self.forward_interrupts, daemon=True, name="worker_pool_interrupt").start()
+
+    def forward_interrupts(self):
+        while True:
+            time.sleep(0.1)
+            if not comfy.model_management.processing_interrupted():
+                continue
+            comfy.model_management.interrupt_current_processing(False)
+            client_id = self.server.interrupt_client_id
+            self.server.interrupt_client_id = None
+            with self.mutex:
+                busy = [w for w in self.workers if w.busy]
+            if client_id is not None:
+                workers = [w for w in busy if w.client_id == client_id]
+            else:
+                workers = sorted(busy, key=lambda w: w.start_time)[-1:]
+            for w in workers:
+                try:
+                    w.send(("interrupt",))
+                except (EOFError, OSError):
+                    pass
+
+    def start_worker(self):
+        while True:
+            worker = WorkerProcess(self.context, self.init, self.threads)
+            if worker.wait_ready():
+                with self.mutex:
+                    self.workers.append(worker)
+                return worker
+            print("Worker process failed to start, retrying")
+            time.sleep(5.0)
+
+    def dispatcher(self):
+        worker = self.start_worker()
+        while True:
+            item, item_id = self.queue.get()
+            prompt_id = item[1]
+            client_id = item[3].get("client_id", None)
+            execution_start_time = time.perf_counter()
+            outputs_ui = {}
+            profile = {}
+            worker.client_id = client_id
+            worker.start_time = execution_start_time
+            worker.busy = True
+            try:
+                worker.send(("execute", prompt_id, item[2], item[3], item[4]))
+                while True:
+                    msg = worker.conn.recv()
+                    if msg[0] == "done":
+                        outputs_ui, profile = msg[1], msg[2]
+                        break
+                    _, event, data, sid = msg
+                    if event == "executing":
+                        self.server.client_id = sid
+                        self.server.last_node_id = data.get("node", None)
+                    self.server.send_sync(event, data, sid)
+            except (EOFError, OSError):
+                print(traceback.format_exc())
+                print("Worker process died while executing prompt", prompt_id)
+                if client_id is not None:
+                    self.server.send_sync("execution_error", {"prompt_id": prompt_id, "node_id": self.server.last_node_id, "exception_message": "Worker process died", "exception_type": "WorkerProcessError", "traceback": [], "executed": [], "current_inputs": [], "current_outputs": []}, client_id)
+                worker.process.kill()
+                with self.mutex:
+                    self.workers.remove(worker)
+                worker = self.start_worker()
+            worker.busy = False
+
+            self.queue.task_done(item_id, outputs_ui, profile)
+            if client_id is not None:
+                self.server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, client_id)
+            print("Prompt executed in {:.2f} seconds".format(time.perf_counter() - execution_start_time))